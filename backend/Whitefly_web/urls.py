@@ -19,6 +19,9 @@ from django.conf import settings
 from django.conf.urls.static import static
 from django.http import JsonResponse
 
+from whitefly.profiling import profile_detail_view, profile_list_view
+from whitefly.views import annotated_media_view, upload_media_view
+
 def api_root(request):
     return JsonResponse({
         'message': 'WhiteFly Detection API',
@@ -33,7 +36,12 @@ def api_root(request):
 urlpatterns = [
     path('', api_root, name='api_root'),  # Root endpoint
     path('api/', include('whitefly.api_urls')),  # REST API endpoints for React frontend
+    path('admin/profiles/', admin.site.admin_view(profile_list_view), name='profile_list'),  # Saved request profiles
+    path('admin/profiles/<str:profile_id>/', admin.site.admin_view(profile_detail_view), name='profile_detail'),
     path('admin/', admin.site.urls),  # Django admin panel
     path('', include('django_prometheus.urls')),  # Prometheus metrics endpoint
+    # Annotated images and cold-tier originals that retention removed from media/
+    path('media/whitefly_results/<str:name>', annotated_media_view, name='annotated_media'),
+    path('media/whitefly_uploads/<str:name>', upload_media_view, name='upload_media'),
 ] + static(settings.MEDIA_URL, document_root=settings.MEDIA_ROOT)
 
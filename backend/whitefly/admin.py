@@ -4,14 +4,159 @@
 #admin.site.register(Image)
 
 
-from django.contrib import admin
-from .models import Image, Result
+from django.contrib import admin, messages
+from django.core.paginator import Paginator
+from django.db import connections
+from django.utils.functional import cached_property
+from .models import Image, Result, UploadSession
+from .utilities import render_annotated_image
+
+
+# Detection runs inside the admin request, so keep a selection small
+RERUN_DETECTION_LIMIT = 20
+
+
+class EstimatedCountPaginator(Paginator):
+    """Use PostgreSQL's planner estimate instead of COUNT(*) for unfiltered large tables"""
+    exact_count_below = 10000
+
+    @cached_property
+    def count(self):
+        query = self.object_list.query
+        connection = connections[self.object_list.db]
+        if connection.vendor == 'postgresql' and not query.where:
+            with connection.cursor() as cursor:
+                cursor.execute(
+                    'SELECT reltuples::bigint FROM pg_class WHERE relname = %s',
+                    [self.object_list.model._meta.db_table],
+                )
+                row = cursor.fetchone()
+            if row and row[0] >= self.exact_count_below:
+                return row[0]
+        return super().count
+
+
+def _read_image(image):
+    with open(image.original_path(), 'rb') as f:
+        return f.read()
+
+
+class UsernameFilter(admin.SimpleListFilter):
+    """Exact username typed into a text box, instead of a link for every user"""
+    title = 'user'
+    parameter_name = 'username'
+    field = 'user__username'
+    template = 'admin/whitefly/input_filter.html'
+
+    def lookups(self, request, model_admin):
+        # Non-empty so the filter is shown; the template renders an input instead
+        return [('', '')]
+
+    def choices(self, changelist):
+        all_choice = next(super().choices(changelist))
+        all_choice['query_parts'] = [
+            (k, v) for k, v in changelist.get_filters_params().items() if k != self.parameter_name
+        ]
+        yield all_choice
+
+    def queryset(self, request, queryset):
+        if self.value():
+            return queryset.filter(**{self.field: self.value().strip()})
+        return queryset
+
+
+class ResultUsernameFilter(UsernameFilter):
+    field = 'image__user__username'
+
+
+class QualityFilter(admin.SimpleListFilter):
+    title = 'quality check'
+    parameter_name = 'quality'
+
+    def lookups(self, request, model_admin):
+        return [('passed', 'Passed'), ('flagged', 'Flagged'), ('unchecked', 'Not checked')]
+
+    def queryset(self, request, queryset):
+        if self.value() == 'passed':
+            return queryset.filter(quality_score__isnull=False, quality_issues='')
+        if self.value() == 'flagged':
+            return queryset.exclude(quality_issues='')
+        if self.value() == 'unchecked':
+            return queryset.filter(quality_score__isnull=True)
+        return queryset
+
 
 @admin.register(Image)
 class ImageAdmin(admin.ModelAdmin):
-    list_display = ('id', 'name', 'images', 'user', 'upload_date','last_modified')  # Add 'id' to display the ID in the admin panel
+    list_display = ('id', 'name', 'images', 'user', 'storage_tier', 'quality_score', 'quality_issues', 'upload_date','last_modified')  # Add 'id' to display the ID in the admin panel
+    list_select_related = ('user',)
+    list_filter = ('upload_date', 'storage_tier', QualityFilter, UsernameFilter)
+    search_fields = ('name',)
+    raw_id_fields = ('user',)
+    paginator = EstimatedCountPaginator
+    show_full_result_count = False  # Skips a second COUNT(*) on filtered pages
 
 @admin.register(Result)
 class ResultAdmin(admin.ModelAdmin):
-    list_display = ('id', 'image', 'annotated_coordinates', 'upload_date', 'last_modified')  # Add 'id' to display the ID in the admin panel
+    list_display = ('id', 'image_name', 'owner', 'whitefly_count', 'upload_date', 'last_modified')  # Add 'id' to display the ID in the admin panel
+    list_select_related = ('image', 'image__user')
+    list_filter = ('upload_date', ResultUsernameFilter)
+    search_fields = ('image__name',)
+    raw_id_fields = ('image',)
+    readonly_fields = ('whitefly_count',)
+    paginator = EstimatedCountPaginator
+    show_full_result_count = False
+    actions = ['rerender_annotations', 'rerun_detection']
+
+    @admin.display(description='Image', ordering='image__name')
+    def image_name(self, obj):
+        return obj.image.name
+
+    @admin.display(description='User', ordering='image__user__username')
+    def owner(self, obj):
+        return obj.image.user
+
+    @admin.action(description='Re-render annotated images')
+    def rerender_annotations(self, request, queryset):
+        done = 0
+        for result in queryset.select_related('image').iterator():
+            try:
+                render_annotated_image(result.image.images.url, _read_image(result.image), result.annotated_coordinates)
+                done += 1
+            except Exception as e:
+                self.message_user(request, f'Result {result.id}: {e}', messages.ERROR)
+        self.message_user(request, f'Re-rendered {done} annotated image(s)', messages.SUCCESS)
+
+    @admin.action(description=f'Re-run detection and re-render (up to {RERUN_DETECTION_LIMIT})')
+    def rerun_detection(self, request, queryset):
+        from .api_views import _detect
+
+        selected = queryset.count()
+        if selected > RERUN_DETECTION_LIMIT:
+            self.message_user(
+                request, f'Select at most {RERUN_DETECTION_LIMIT} results to re-run ({selected} selected)', messages.ERROR
+            )
+            return
+        done = 0
+        for result in queryset.select_related('image').iterator():
+            try:
+                bin_data = _read_image(result.image)
+                # Same admission slots as uploads, so the admin cannot starve users
+                boxes, error_response = _detect(request.user, result.image.name, result.image.name, bin_data)
+                if error_response is not None:
+                    self.message_user(request, f"Result {result.id}: {error_response.data['error']}", messages.ERROR)
+                    break
+                result.annotated_coordinates = boxes
+                result.save()
+                render_annotated_image(result.image.images.url, bin_data, result.annotated_coordinates)
+                done += 1
+            except Exception as e:
+                self.message_user(request, f'Result {result.id}: {e}', messages.ERROR)
+        self.message_user(request, f'Re-ran detection for {done} result(s)', messages.SUCCESS)
 
+@admin.register(UploadSession)
+class UploadSessionAdmin(admin.ModelAdmin):
+    list_display = ('id', 'user', 'filename', 'size', 'offset', 'status', 'upload_date', 'last_modified')
+    list_select_related = ('user',)
+    list_filter = ('status',)
+    raw_id_fields = ('user', 'result')
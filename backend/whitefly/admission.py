@@ -0,0 +1,189 @@
+"""Admission control for image processing.
+
+Every image sent for detection takes a slot in a small SQLite store shared by
+all gunicorn workers on the host. A slot is granted only while the user and
+the whole server are under their in-flight limits; otherwise the request waits
+in a fair-share queue (the waiting user with the fewest images in flight goes
+first) and gives up with ``AdmissionRejected`` after ``UPLOAD_QUEUE_TIMEOUT``.
+"""
+import os
+import sqlite3
+import threading
+import time
+from contextlib import contextmanager
+
+from django.conf import settings
+from prometheus_client import Gauge
+
+
+class AdmissionRejected(Exception):
+    def __init__(self, retry_after):
+        super().__init__(f'Server busy, retry after {retry_after}s')
+        self.retry_after = retry_after
+
+
+def _pid_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
+
+
+class SharedStore:
+    """A SQLite file used by every worker process on the host"""
+
+    def __init__(self, path):
+        self.path = str(path)
+        self._local = threading.local()
+
+    @property
+    def _db(self):
+        # sqlite3 connections cannot be shared between threads
+        db = getattr(self._local, 'db', None)
+        if db is None or getattr(self._local, 'pid', None) != os.getpid():
+            os.makedirs(os.path.dirname(self.path) or '.', exist_ok=True)
+            db = sqlite3.connect(self.path, timeout=10, isolation_level=None)
+            db.execute('PRAGMA journal_mode=WAL;')
+            self._local.db = db
+            self._local.pid = os.getpid()
+        return db
+
+    @contextmanager
+    def _transaction(self):
+        db = self._db
+        # IMMEDIATE takes the write lock up front, so check-and-insert is atomic across workers
+        db.execute('BEGIN IMMEDIATE')
+        try:
+            yield db
+        except BaseException:
+            db.execute('ROLLBACK')
+            raise
+        db.execute('COMMIT')
+
+
+class AdmissionController(SharedStore):
+    def __init__(self, path, per_user, global_limit, queue_timeout, retry_after,
+                 slot_ttl=600, poll_interval=0.1):
+        super().__init__(path)
+        self.per_user = per_user
+        self.global_limit = global_limit
+        self.queue_timeout = queue_timeout
+        self.retry_after = retry_after
+        self.slot_ttl = slot_ttl
+        self.poll_interval = poll_interval
+
+        with self._transaction() as db:
+            db.execute(
+                'CREATE TABLE IF NOT EXISTS inflight ('
+                'id INTEGER PRIMARY KEY, user_id INTEGER, images INTEGER, pid INTEGER, acquired REAL)'
+            )
+            db.execute(
+                'CREATE TABLE IF NOT EXISTS waiting ('
+                'id INTEGER PRIMARY KEY, user_id INTEGER, pid INTEGER, enqueued REAL)'
+            )
+
+    def _purge(self, db):
+        """Drop slots and queue entries left behind by crashed or killed workers"""
+        db.execute('DELETE FROM inflight WHERE acquired < ?', (time.time() - self.slot_ttl,))
+        pids = {row[0] for row in db.execute('SELECT pid FROM inflight UNION SELECT pid FROM waiting')}
+        for pid in pids:
+            if not _pid_alive(pid):
+                db.execute('DELETE FROM inflight WHERE pid = ?', (pid,))
+                db.execute('DELETE FROM waiting WHERE pid = ?', (pid,))
+
+    def _can_admit(self, db, user_id, waiter_id, images):
+        in_flight = db.execute('SELECT COALESCE(SUM(images), 0) FROM inflight').fetchone()[0]
+        # An idle server always admits, even a request larger than the limit
+        if in_flight and in_flight + images > self.global_limit:
+            return False
+
+        waiters = db.execute(
+            'SELECT w.id, w.user_id, w.enqueued, '
+            '(SELECT COALESCE(SUM(i.images), 0) FROM inflight i WHERE i.user_id = w.user_id) '
+            'FROM waiting w'
+        ).fetchall()
+        eligible = [w for w in waiters if w[3] == 0 or w[3] + images <= self.per_user]
+        if not any(w[0] == waiter_id for w in eligible):
+            return False
+
+        # Fair share: fewest images in flight first, then first come first served
+        best = min(eligible, key=lambda w: (w[3], w[2], w[0]))
+        return best[0] == waiter_id
+
+    def acquire(self, user_id, images=1):
+        """Block until a slot is granted, returning its id, or raise AdmissionRejected"""
+        with self._transaction() as db:
+            waiter_id = db.execute(
+                'INSERT INTO waiting (user_id, pid, enqueued) VALUES (?, ?, ?)',
+                (user_id, os.getpid(), time.time()),
+            ).lastrowid
+
+        deadline = time.monotonic() + self.queue_timeout
+        try:
+            while True:
+                with self._transaction() as db:
+                    self._purge(db)
+                    if self._can_admit(db, user_id, waiter_id, images):
+                        slot_id = db.execute(
+                            'INSERT INTO inflight (user_id, images, pid, acquired) VALUES (?, ?, ?, ?)',
+                            (user_id, images, os.getpid(), time.time()),
+                        ).lastrowid
+                        db.execute('DELETE FROM waiting WHERE id = ?', (waiter_id,))
+                        waiter_id = None
+                        return slot_id
+                if time.monotonic() >= deadline:
+                    raise AdmissionRejected(self.retry_after)
+                time.sleep(self.poll_interval)
+        finally:
+            if waiter_id is not None:
+                with self._transaction() as db:
+                    db.execute('DELETE FROM waiting WHERE id = ?', (waiter_id,))
+
+    def release(self, slot_id):
+        with self._transaction() as db:
+            db.execute('DELETE FROM inflight WHERE id = ?', (slot_id,))
+
+    @contextmanager
+    def admitted(self, user_id, images=1):
+        slot_id = self.acquire(user_id, images)
+        try:
+            yield
+        finally:
+            self.release(slot_id)
+
+    def queue_depth(self):
+        return self._db.execute('SELECT COUNT(*) FROM waiting').fetchone()[0]
+
+    def in_flight(self):
+        return self._db.execute('SELECT COALESCE(SUM(images), 0) FROM inflight').fetchone()[0]
+
+
+_controller = None
+_controller_lock = threading.Lock()
+
+
+def get_controller():
+    """The admission controller for this process, built from settings on first use"""
+    global _controller
+    if _controller is None:
+        with _controller_lock:
+            if _controller is None:
+                _controller = AdmissionController(
+                    settings.UPLOAD_ADMISSION_STORE,
+                    per_user=settings.UPLOAD_MAX_INFLIGHT_PER_USER,
+                    global_limit=settings.UPLOAD_MAX_INFLIGHT_GLOBAL,
+                    queue_timeout=settings.UPLOAD_QUEUE_TIMEOUT,
+                    retry_after=settings.UPLOAD_RETRY_AFTER,
+                )
+    return _controller
+
+
+# Read from the shared store at scrape time, so every worker reports the host-wide value
+UPLOAD_QUEUE_DEPTH = Gauge('whitefly_upload_queue_depth', 'Images waiting for an admission slot')
+UPLOAD_QUEUE_DEPTH.set_function(lambda: get_controller().queue_depth())
+
+UPLOAD_IN_FLIGHT = Gauge('whitefly_upload_images_in_flight', 'Images holding an admission slot')
+UPLOAD_IN_FLIGHT.set_function(lambda: get_controller().in_flight())
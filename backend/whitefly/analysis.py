@@ -0,0 +1,127 @@
+"""Spatial analysis of whitefly detections: centroids, density heatmaps, clusters.
+
+Everything works on NumPy arrays so an image with thousands of boxes, or all of
+a user's results at once, is a handful of vectorized passes.
+"""
+import cv2
+import numpy as np
+
+
+def boxes_from_annotations(annotated_coordinates):
+    """Convert ``Result.annotated_coordinates`` into an (N, 4) xmin/ymin/xmax/ymax array"""
+    boxes = [
+        (c['xmin'], c['ymin'], c['xmax'], c['ymax'])
+        for d in annotated_coordinates or []
+        for c in d.values()
+    ]
+    if not boxes:
+        return np.empty((0, 4), dtype=np.float64)
+    return np.asarray(boxes, dtype=np.float64)
+
+
+def box_centroids(boxes):
+    """(N, 2) x/y centres of an (N, 4) box array (works with swapped min/max)"""
+    return np.column_stack((
+        (boxes[:, 0] + boxes[:, 2]) / 2.0,
+        (boxes[:, 1] + boxes[:, 3]) / 2.0,
+    ))
+
+
+def density_grid(points, width, height, bins, sigma):
+    """Smoothed 2D histogram of points, shape (bins, bins) indexed [row=y, col=x]"""
+    grid, _, _ = np.histogram2d(
+        points[:, 1], points[:, 0],
+        bins=bins, range=[[0, height], [0, width]],
+    )
+    grid = grid.astype(np.float32)
+    if sigma > 0:
+        # Kernel size 0 lets OpenCV derive it from sigma
+        grid = cv2.GaussianBlur(grid, (0, 0), sigma, borderType=cv2.BORDER_CONSTANT)
+    return grid
+
+
+def cluster_statistics(points, grid, width, height, threshold, max_clusters=10):
+    """Cluster detections by connected regions of the density grid above ``threshold`` x peak"""
+    count = len(points)
+    bins_y, bins_x = grid.shape
+    stats = {
+        'detections': count,
+        'clusters': [],
+        'cluster_count': 0,
+        'clustered_fraction': 0.0,
+        'dispersion_index': None,
+        'mean_centroid': None,
+        'spread': None,
+    }
+    if count == 0:
+        return stats
+
+    stats['mean_centroid'] = [round(float(v), 4) for v in points.mean(axis=0)]
+    stats['spread'] = [round(float(v), 4) for v in points.std(axis=0)]
+
+    # Bin every point once; reused for the dispersion index and cluster membership
+    col = np.clip((points[:, 0] * bins_x / width).astype(np.intp), 0, bins_x - 1)
+    row = np.clip((points[:, 1] * bins_y / height).astype(np.intp), 0, bins_y - 1)
+    cell_counts = np.bincount(row * bins_x + col, minlength=bins_y * bins_x)
+
+    # Variance/mean of per-cell counts: ~1 random, >1 aggregated, <1 regular
+    mean = cell_counts.mean()
+    stats['dispersion_index'] = round(float(cell_counts.var() / mean), 3) if mean else None
+
+    peak = float(grid.max())
+    if peak <= 0:
+        return stats
+    mask = (grid >= peak * threshold).astype(np.uint8)
+    n_labels, labels, label_stats, _ = cv2.connectedComponentsWithStats(mask, connectivity=8)
+
+    # Label 0 is the background; points that land there are not in any cluster
+    point_labels = labels[row, col]
+    members = np.bincount(point_labels, minlength=n_labels)
+    sum_x = np.bincount(point_labels, weights=points[:, 0], minlength=n_labels)
+    sum_y = np.bincount(point_labels, weights=points[:, 1], minlength=n_labels)
+
+    order = [i for i in np.argsort(-members) if i != 0 and members[i] > 0]
+    stats['cluster_count'] = len(order)
+    stats['clustered_fraction'] = round(float(members[1:].sum()) / count, 3)
+    stats['clusters'] = [
+        {
+            'count': int(members[i]),
+            'center': [round(float(sum_x[i] / members[i]), 4), round(float(sum_y[i] / members[i]), 4)],
+            'area_fraction': round(float(label_stats[i, cv2.CC_STAT_AREA]) / (bins_x * bins_y), 4),
+        }
+        for i in order[:max_clusters]
+    ]
+    return stats
+
+
+def render_heatmap(grid, size, background=None, alpha=0.45):
+    """Colour-map a density grid to ``size`` (width, height), blended over a BGR background"""
+    peak = float(grid.max())
+    scaled = grid / peak * 255.0 if peak > 0 else grid
+    heat = cv2.resize(scaled.astype(np.uint8), size, interpolation=cv2.INTER_LINEAR)
+    heat = cv2.applyColorMap(heat, cv2.COLORMAP_JET)
+    if background is None:
+        return heat
+    return cv2.addWeighted(background, 1.0 - alpha, heat, alpha, 0)
+
+
+def analyze_detections(annotated_coordinates, width, height, bins, sigma, threshold):
+    """Density grid and cluster statistics for one image's detections"""
+    points = box_centroids(boxes_from_annotations(annotated_coordinates))
+    grid = density_grid(points, width, height, bins, sigma)
+    return grid, cluster_statistics(points, grid, width, height, threshold)
+
+
+def analyze_many(results, bins, sigma, threshold):
+    """Aggregate density over many images in normalized [0, 1] coordinates.
+
+    ``results`` yields (annotated_coordinates, width, height) tuples.
+    """
+    chunks = []
+    for annotated_coordinates, width, height in results:
+        points = box_centroids(boxes_from_annotations(annotated_coordinates))
+        if len(points) and width and height:
+            chunks.append(points / np.array([width, height], dtype=np.float64))
+    points = np.concatenate(chunks) if chunks else np.empty((0, 2), dtype=np.float64)
+    grid = density_grid(points, 1.0, 1.0, bins, sigma)
+    return grid, cluster_statistics(points, grid, 1.0, 1.0, threshold)
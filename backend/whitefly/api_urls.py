@@ -16,8 +16,21 @@ urlpatterns = [
     # Image Upload & Processing
     path('upload/', api_views.upload_images_view, name='upload'),
     
+    # Resumable chunked upload (one session per image)
+    path('uploads/', api_views.upload_session_create_view, name='upload_session_create'),
+    path('uploads/<uuid:upload_id>/', api_views.upload_session_detail_view, name='upload_session_detail'),
+    path('uploads/<uuid:upload_id>/chunk/', api_views.upload_chunk_view, name='upload_chunk'),
+    path('uploads/<uuid:upload_id>/complete/', api_views.upload_complete_view, name='upload_complete'),
+    
     # Results
     path('images/', api_views.get_user_images_view, name='user_images'),
     path('results/', api_views.get_user_results_view, name='user_results'),
     path('results/<int:result_id>/', api_views.get_result_detail_view, name='result_detail'),
+    
+    # Export
+    path('export/', api_views.export_view, name='export'),
+    
+    # Spatial analysis
+    path('results/<int:result_id>/heatmap/', api_views.result_heatmap_view, name='result_heatmap'),
+    path('analysis/density/', api_views.user_density_view, name='user_density'),
 ]
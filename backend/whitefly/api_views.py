@@ -5,17 +5,46 @@ from rest_framework.permissions import AllowAny, IsAuthenticated
 from django.contrib.auth import login, logout
 from django.contrib.auth.models import User
 from django.middleware.csrf import get_token
+from django.db import transaction
+from django.db.models import Count, Max
+from django.core.files.base import ContentFile
+from django.utils import timezone
+from django.http import HttpResponse, StreamingHttpResponse
+from django.utils.dateparse import parse_date
+from django.utils.http import quote_etag
 from django.views.decorators.csrf import ensure_csrf_cookie
-from .models import Image, Result
+from .models import Image, Result, UploadSession
+from .cache import cached_api_response
+from .admission import AdmissionRejected, get_controller
+from .export import iter_export_zip, purge_export_cache
+from .profiling import stage
 from .serializers import (
     UserSerializer, SignUpSerializer, ImageSerializer, 
     ResultSerializer, UploadResponseSerializer
 )
-from .utilities import post_image, draw_annotations, save_img, save_results
+from .utilities import (
+    post_image, save_img, save_results, decode_image, get_image_size,
+    render_annotated_image, annotated_image_path
+)
+from django.conf import settings
 import os
 import time
+import hashlib
+import json
+import traceback
+import re
+import shutil
+import threading
+import uuid
+from contextlib import contextmanager
+from datetime import timedelta
 from os.path import basename
 
+try:
+    import fcntl
+except ImportError:  # Windows development server: one process, so a thread lock is enough
+    fcntl = None
+
 
 BASE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
 csv_dir = os.path.normpath(BASE_DIR + "/media/csv/results.csv")
@@ -91,6 +120,231 @@ def current_user_view(request):
     return Response(serializer.data)
 
 
+def _detect(user, upload_name, filename, bin_data):
+    """Send one image to the detection API, returning (boxes, error_response)"""
+    try:
+        # Waits for a per-user/global in-flight slot, fairly shared between users
+        controller = get_controller()
+        with stage('admission_wait'):
+            slot_id = controller.acquire(user.pk)
+        try:
+            with stage('detect'):
+                dets = post_image([("files", (upload_name, bin_data))])
+        finally:
+            controller.release(slot_id)
+    except AdmissionRejected as rejected:
+        return None, Response({
+            'error': f'Server is busy, {filename} was not processed. Retry in {rejected.retry_after} seconds',
+            'retry_after': rejected.retry_after
+        }, status=status.HTTP_429_TOO_MANY_REQUESTS, headers={'Retry-After': str(rejected.retry_after)})
+    except Exception as api_error:
+        return None, Response({
+            'error': f'Detection API connection failed: {str(api_error)}. Make sure a detection server in DETECTION_API_URLS is running'
+        }, status=status.HTTP_503_SERVICE_UNAVAILABLE)
+    
+    if not dets or dets == "Failed to fetch results":
+        return None, Response({
+            'error': f'Detection API failed for {filename}. Make sure a detection server in DETECTION_API_URLS is running'
+        }, status=status.HTTP_503_SERVICE_UNAVAILABLE)
+    
+    return dets[0]['result'], None
+
+
+def _check_quality(filename, bin_data):
+    """Run the quality gate, returning (quality, rejected); quality is None when the gate is off"""
+    if settings.QUALITY_GATE == 'off':
+        return None, None
+    from .quality import ISSUE_UNREADABLE, assess_image
+    
+    with stage('quality'):
+        quality = assess_image(bin_data)
+    # Undecodable files can only fail in detection, so they are refused in every mode
+    if ISSUE_UNREADABLE in quality['issues'] or (quality['issues'] and settings.QUALITY_GATE == 'reject'):
+        return quality, {
+            'image_name': filename,
+            'error': f"{filename} failed the quality check ({', '.join(quality['issues'])}) and was not processed",
+            'quality': quality
+        }
+    return quality, None
+
+
+def _quality_fields(quality):
+    """Image model fields recording a quality check"""
+    if quality is None:
+        return {}
+    return {'quality_score': quality['score'], 'quality_issues': ','.join(quality['issues'])}
+
+
+def _result_payload(instance, results_instance):
+    """Response entry for a processed image"""
+    return {
+        'image_id': instance.id,
+        'result_id': results_instance.id,
+        'image_name': instance.name,
+        'whitefly_count': results_instance.whitefly_count,
+        'quality_score': instance.quality_score,
+        'quality_issues': instance.quality_issues.split(',') if instance.quality_issues else [],
+        'annotated_image_url': f'/media/whitefly_results/{os.path.basename(instance.images.url)}',
+        'original_image_url': instance.images.url
+    }
+
+
+def _render_result(instance, results_instance, upload_name, bin_data, boxes):
+    """Save the annotated image and CSV row for a stored result"""
+    # Draw annotations and save them to media/whitefly_results
+    with stage('annotate'):
+        render_annotated_image(instance.images.url, bin_data, boxes)
+    
+    # Save results to CSV
+    with stage('csv'):
+        save_results(upload_name, len(boxes), csv_dir)
+    
+    return _result_payload(instance, results_instance)
+
+
+def _read_upload(f):
+    """Whole content of an uploaded file, leaving it rewound"""
+    f.seek(0)
+    bin_data = f.read()
+    f.seek(0)
+    return bin_data
+
+
+def _read_size(filename, bin_data):
+    """Pixel size from the image header, returning ((width, height), error_response)"""
+    try:
+        return get_image_size(bin_data), None
+    except Exception:
+        return None, Response({
+            'error': f'{filename} is not a readable image'
+        }, status=status.HTTP_400_BAD_REQUEST)
+
+
+def _stored_image(f, user, filename, width, height, quality):
+    """Unsaved Image whose file is already in storage.
+
+    Files are written before the database transaction so the write lock is
+    not held across file I/O; pass the instances to _discard_files if the
+    transaction fails.
+    """
+    instance = Image(user=user, name=filename, width=width, height=height, **_quality_fields(quality))
+    with stage('file_write'):
+        instance.images.save(filename, f, save=False)
+    return instance
+
+
+def _discard_files(instances):
+    """Delete the stored files of Image rows that were never committed"""
+    for instance in instances:
+        try:
+            instance.images.delete(save=False)
+        except OSError:
+            pass
+
+
+def _process_single_upload(f, user):
+    """Detect, store and render one uploaded file, returning (payload, error_response)"""
+    filename = basename(f.name)
+    bin_data = _read_upload(f)
+    
+    # Checked before detection so a non-image never costs a detector call
+    size, error_response = _read_size(filename, bin_data)
+    if error_response is not None:
+        return None, error_response
+    width, height = size
+    
+    quality, rejected = _check_quality(filename, bin_data)
+    if rejected is not None:
+        return None, Response(rejected, status=status.HTTP_422_UNPROCESSABLE_ENTITY)
+    
+    boxes, error_response = _detect(user, f.name, filename, bin_data)
+    if error_response is not None:
+        return None, error_response
+    
+    instance = _stored_image(f, user, filename, width, height, quality)
+    try:
+        with stage('db_write'), transaction.atomic():
+            instance.save()
+            
+            results_instance = Result(
+                image=instance, 
+                annotated_coordinates=boxes
+            )
+            results_instance.save()
+    except Exception:
+        _discard_files([instance])
+        raise
+    
+    return _render_result(instance, results_instance, f.name, bin_data, boxes), None
+
+
+STREAM_CONTENT_TYPES = {
+    'ndjson': 'application/x-ndjson',
+    'sse': 'text/event-stream',
+}
+
+
+def _format_event(event, stream_format):
+    data = json.dumps(event)
+    if stream_format == 'sse':
+        return f"event: {event['type']}\ndata: {data}\n\n"
+    return data + "\n"
+
+
+def _stream_upload_events(images, user, stream_format):
+    """Yield one event per image as soon as it is processed, then a summary"""
+    processed = 0
+    failed = 0
+    rejected = 0
+    not_processed = 0
+    retry_after = None
+    
+    for index, f in enumerate(images):
+        filename = basename(f.name)
+        try:
+            payload, error_response = _process_single_upload(f, user)
+            error = error_response.data['error'] if error_response is not None else None
+        except Exception as e:
+            print(f"Error processing {filename}: {traceback.format_exc()}")
+            payload, error_response, error = None, None, f'Error processing {filename}: {str(e)}'
+        
+        if error_response is not None and error_response.status_code == status.HTTP_429_TOO_MANY_REQUESTS:
+            # The server is busy: waiting again for each remaining image would
+            # hold this worker for the whole queue timeout per image
+            retry_after = error_response.data['retry_after']
+            for remaining in images[index:]:
+                not_processed += 1
+                yield _format_event({
+                    'type': 'not_processed',
+                    'image_name': basename(remaining.name),
+                    'error': error,
+                    'retry_after': retry_after
+                }, stream_format)
+            break
+        
+        # One bad image does not abort the rest of a streamed batch
+        if error_response is not None and error_response.status_code == status.HTTP_422_UNPROCESSABLE_ENTITY:
+            rejected += 1
+            event = {'type': 'rejected', **error_response.data}
+        elif error is not None:
+            failed += 1
+            event = {'type': 'error', 'image_name': filename, 'error': error}
+        else:
+            processed += 1
+            event = {'type': 'result', **payload}
+        yield _format_event(event, stream_format)
+    
+    yield _format_event({
+        'type': 'done',
+        'message': f'Successfully processed {processed} image(s)',
+        'processed': processed,
+        'failed': failed,
+        'rejected': rejected,
+        'not_processed': not_processed,
+        'retry_after': retry_after
+    }, stream_format)
+
+
 @api_view(['POST'])
 @permission_classes([IsAuthenticated])
 def upload_images_view(request):
@@ -100,6 +354,17 @@ def upload_images_view(request):
             'error': 'Invalid request method'
         }, status=status.HTTP_400_BAD_REQUEST)
     
+    # Refuse oversized bodies from the header, before the multipart body is
+    # read and spooled to disk
+    try:
+        content_length = int(request.META.get('CONTENT_LENGTH') or 0)
+    except ValueError:
+        content_length = 0
+    if content_length > settings.UPLOAD_MAX_BYTES_PER_REQUEST:
+        return Response({
+            'error': f'Upload too large, limit is {settings.UPLOAD_MAX_BYTES_PER_REQUEST} bytes per request'
+        }, status=status.HTTP_413_REQUEST_ENTITY_TOO_LARGE)
+    
     images = request.FILES.getlist('images')
     
     if not images:
@@ -107,119 +372,752 @@ def upload_images_view(request):
             'error': 'No images provided'
         }, status=status.HTTP_400_BAD_REQUEST)
     
+    if len(images) > settings.UPLOAD_MAX_IMAGES_PER_REQUEST:
+        return Response({
+            'error': f'Too many images, limit is {settings.UPLOAD_MAX_IMAGES_PER_REQUEST} per request'
+        }, status=status.HTTP_413_REQUEST_ENTITY_TOO_LARGE)
+    
+    if sum(f.size for f in images) > settings.UPLOAD_MAX_BYTES_PER_REQUEST:
+        return Response({
+            'error': f'Upload too large, limit is {settings.UPLOAD_MAX_BYTES_PER_REQUEST} bytes per request'
+        }, status=status.HTTP_413_REQUEST_ENTITY_TOO_LARGE)
+    
     # Ensure media directories exist
     results_dir = os.path.join(BASE_DIR, 'media', 'whitefly_results')
     csv_dir_path = os.path.join(BASE_DIR, 'media', 'csv')
     os.makedirs(results_dir, exist_ok=True)
     os.makedirs(csv_dir_path, exist_ok=True)
     
+    # ?stream=ndjson|sse sends each image's result as soon as it is ready,
+    # committing per image instead of per batch
+    stream_format = request.query_params.get('stream')
+    if stream_format in STREAM_CONTENT_TYPES:
+        response = StreamingHttpResponse(
+            _stream_upload_events(images, request.user, stream_format),
+            content_type=STREAM_CONTENT_TYPES[stream_format]
+        )
+        response['Cache-Control'] = 'no-cache'
+        response['X-Accel-Buffering'] = 'no'  # Stop proxies from buffering the stream
+        return response
+    
     results = []
+    detections = []
+    rejected = []
+    not_processed = []
+    headers = {}
     current_user = request.user
     
+    # Read every file header first, so an unreadable file fails the request
+    # before any detector time is spent on the others. Only one file's bytes
+    # are held at a time; each is read again from the upload when needed.
+    uploads = []
     for f in images:
-        try:
-            # Extract filename
-            filename = basename(f.name)
-            
-            # Read image data FIRST (before saving to database)
-            f.seek(0)  # Ensure we're at the start of the file
-            bin_data = f.read()
-            
-            # Reset file pointer for database save
+        # Extract filename
+        filename = basename(f.name)
+        
+        size, error_response = _read_size(filename, _read_upload(f))
+        if error_response is not None:
+            return error_response
+        uploads.append((f, filename, size))
+    
+    # Run detection for the whole batch before touching the database, so the
+    # write transaction below is never held open across detector round trips
+    for index, (f, filename, size) in enumerate(uploads):
+        bin_data = _read_upload(f)
+        
+        # Images failing the quality gate are skipped (QUALITY_GATE=reject) or flagged
+        quality, rejected_entry = _check_quality(filename, bin_data)
+        if rejected_entry is not None:
+            rejected.append(rejected_entry)
+            continue
+        
+        # Send to detection API
+        boxes, error_response = _detect(current_user, f.name, filename, bin_data)
+        if error_response is not None:
+            if not detections:
+                return error_response
+            # Keep the inference already done: store what finished, report the rest
+            not_processed = [
+                {'image_name': name, 'error': error_response.data['error']}
+                for _, name, _ in uploads[index:]
+            ]
+            if error_response.has_header('Retry-After'):
+                headers['Retry-After'] = error_response['Retry-After']
+            break
+        
+        detections.append((f, filename, size, quality, boxes))
+    bin_data = None  # Drop the last image before the save and render passes
+    
+    if not detections:
+        return Response({
+            'error': 'No images passed the quality check',
+            'rejected': rejected
+        }, status=status.HTTP_422_UNPROCESSABLE_ENTITY)
+    
+    filename = None
+    stored = []
+    try:
+        # Write the files first, then save the whole batch in one transaction
+        # (one write lock on SQLite, not held across file I/O)
+        for f, filename, (width, height), quality, boxes in detections:
             f.seek(0)
+            stored.append(_stored_image(f, current_user, filename, width, height, quality))
+        
+        saved = []
+        try:
+            with stage('db_write'), transaction.atomic():
+                for instance, (f, filename, size, quality, boxes) in zip(stored, detections):
+                    instance.save()
+                    
+                    results_instance = Result(
+                        image=instance, 
+                        annotated_coordinates=boxes
+                    )
+                    results_instance.save()
+                    saved.append((instance, results_instance, f, filename, boxes))
+        except Exception:
+            _discard_files(stored)
+            raise
+        
+        for instance, results_instance, f, filename, boxes in saved:
+            results.append(_render_result(instance, results_instance, f.name, _read_upload(f), boxes))
             
-            # Save image to database
-            instance = Image(images=f, user=current_user, name=filename)
-            instance.save()
-            
-            # Send to detection API
+    except Exception as e:
+        error_details = traceback.format_exc()
+        print(f"Error processing {filename}: {error_details}")
+        return Response({
+            'error': f'Error processing {filename}: {str(e)}'
+        }, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
+    
+    return Response({
+        'message': f'Successfully processed {len(results)} image(s)',
+        'results': results,
+        'rejected': rejected,
+        'not_processed': not_processed
+    }, status=status.HTTP_200_OK, headers=headers)
+
+
+def _chunk_path(session):
+    return os.path.join(settings.CHUNKED_UPLOAD_DIR, f'{session.id}.part')
+
+
+OPEN_UPLOAD_STATUSES = (UploadSession.STATUS_UPLOADING, UploadSession.STATUS_PROCESSING)
+
+
+def purge_expired_uploads():
+    """Delete idle upload sessions and part files older than CHUNKED_UPLOAD_EXPIRY_HOURS"""
+    cutoff = timezone.now() - timedelta(hours=settings.CHUNKED_UPLOAD_EXPIRY_HOURS)
+    UploadSession.objects.filter(status__in=OPEN_UPLOAD_STATUSES, last_modified__lt=cutoff).delete()
+    
+    upload_dir = settings.CHUNKED_UPLOAD_DIR
+    if not os.path.isdir(upload_dir):
+        return
+    # Part files (and unmerged chunks) of expired, finished or vanished sessions
+    old = {}
+    for name in os.listdir(upload_dir):
+        path = os.path.join(upload_dir, name)
+        try:
+            if os.path.getmtime(path) < cutoff.timestamp():
+                old.setdefault(name.split('.')[0], []).append(path)
+        except OSError:
+            pass
+    valid_ids = []
+    for upload_id in old:
+        try:
+            valid_ids.append(uuid.UUID(upload_id))
+        except ValueError:
+            pass
+    live = {
+        str(upload_id) for upload_id in UploadSession.objects.filter(
+            id__in=valid_ids, status__in=OPEN_UPLOAD_STATUSES
+        ).values_list('id', flat=True)
+    }
+    for upload_id, paths in old.items():
+        if upload_id in live:
+            continue
+        for path in paths:
             try:
-                dets = post_image([("files", (f.name, bin_data))])
-            except Exception as api_error:
-                return Response({
-                    'error': f'Detection API connection failed: {str(api_error)}. Make sure the detection server is running on localhost:5000'
-                }, status=status.HTTP_503_SERVICE_UNAVAILABLE)
+                os.remove(path)
+            except OSError:
+                pass
+
+
+_part_lock = threading.Lock()
+
+
+@contextmanager
+def _locked_part(session):
+    """Open the session's part file with an exclusive lock held across workers"""
+    with open(_chunk_path(session), 'r+b') as part:
+        if fcntl is not None:
+            fcntl.flock(part.fileno(), fcntl.LOCK_EX)
+            try:
+                yield part
+            finally:
+                fcntl.flock(part.fileno(), fcntl.LOCK_UN)
+        else:
+            with _part_lock:
+                yield part
+
+
+def _session_payload(session):
+    payload = {
+        'upload_id': str(session.id),
+        'filename': session.filename,
+        'size': session.size,
+        'offset': session.offset,
+        'status': session.status,
+        'max_chunk_size': settings.CHUNKED_UPLOAD_MAX_CHUNK_SIZE,
+    }
+    if session.status == UploadSession.STATUS_COMPLETE and session.result is not None:
+        payload['result'] = _result_payload(session.result.image, session.result)
+    return payload
+
+
+def _get_upload_session(request, upload_id):
+    """Look up the user's upload session, returning (session, error_response)"""
+    try:
+        session = UploadSession.objects.select_related('result__image').get(id=upload_id, user=request.user)
+    except UploadSession.DoesNotExist:
+        return None, Response({
+            'error': 'Upload not found'
+        }, status=status.HTTP_404_NOT_FOUND)
+    
+    now = timezone.now()
+    stale = session.last_modified + timedelta(seconds=settings.CHUNKED_UPLOAD_PROCESSING_TIMEOUT)
+    if session.status == UploadSession.STATUS_PROCESSING and stale < now:
+        # The worker that claimed it died mid-detection; the data is still on disk
+        reopened = UploadSession.objects.filter(
+            pk=session.pk, status=UploadSession.STATUS_PROCESSING, last_modified=session.last_modified
+        ).update(status=UploadSession.STATUS_UPLOADING)
+        if reopened:
+            session.status = UploadSession.STATUS_UPLOADING
+    
+    expires = session.last_modified + timedelta(hours=settings.CHUNKED_UPLOAD_EXPIRY_HOURS)
+    if session.status == UploadSession.STATUS_UPLOADING and expires < now:
+        if os.path.exists(_chunk_path(session)):
+            os.remove(_chunk_path(session))
+        session.delete()
+        return None, Response({
+            'error': 'Upload expired, start a new one'
+        }, status=status.HTTP_410_GONE)
+    
+    return session, None
+
+
+@api_view(['POST'])
+@permission_classes([IsAuthenticated])
+def upload_session_create_view(request):
+    """Start a resumable upload: {filename, size, sha256 (optional)}"""
+    filename = basename(str(request.data.get('filename') or ''))
+    sha256 = str(request.data.get('sha256') or '').lower()
+    try:
+        size = int(request.data.get('size'))
+    except (TypeError, ValueError):
+        size = 0
+    
+    if not filename or size <= 0:
+        return Response({
+            'error': 'Please provide filename and size'
+        }, status=status.HTTP_400_BAD_REQUEST)
+    
+    if size > settings.CHUNKED_UPLOAD_MAX_SIZE:
+        return Response({
+            'error': f'File too large, limit is {settings.CHUNKED_UPLOAD_MAX_SIZE} bytes'
+        }, status=status.HTTP_413_REQUEST_ENTITY_TOO_LARGE)
+    
+    if sha256 and len(sha256) != 64:
+        return Response({
+            'error': 'sha256 must be a hex digest'
+        }, status=status.HTTP_400_BAD_REQUEST)
+    
+    # Each open session can reserve CHUNKED_UPLOAD_MAX_SIZE on disk
+    purge_expired_uploads()
+    open_sessions = UploadSession.objects.filter(user=request.user, status__in=OPEN_UPLOAD_STATUSES).count()
+    if open_sessions >= settings.CHUNKED_UPLOAD_MAX_OPEN_PER_USER:
+        return Response({
+            'error': f'Too many unfinished uploads, limit is {settings.CHUNKED_UPLOAD_MAX_OPEN_PER_USER}. '
+                     'Complete them or wait for them to expire'
+        }, status=status.HTTP_429_TOO_MANY_REQUESTS)
+    
+    session = UploadSession.objects.create(
+        user=request.user, filename=filename, size=size, sha256=sha256
+    )
+    os.makedirs(settings.CHUNKED_UPLOAD_DIR, exist_ok=True)
+    open(_chunk_path(session), 'wb').close()
+    
+    return Response(_session_payload(session), status=status.HTTP_201_CREATED)
+
+
+@api_view(['GET'])
+@permission_classes([IsAuthenticated])
+def upload_session_detail_view(request, upload_id):
+    """Current offset of an upload, used to resume after a dropped connection"""
+    session, error_response = _get_upload_session(request, upload_id)
+    if error_response is not None:
+        return error_response
+    return Response(_session_payload(session))
+
+
+@api_view(['PUT'])
+@permission_classes([IsAuthenticated])
+def upload_chunk_view(request, upload_id):
+    """Append one chunk: raw body, Upload-Offset and X-Chunk-SHA256 headers"""
+    session, error_response = _get_upload_session(request, upload_id)
+    if error_response is not None:
+        return error_response
+    
+    if session.status != UploadSession.STATUS_UPLOADING:
+        return Response({
+            'error': 'Upload already finished'
+        }, status=status.HTTP_409_CONFLICT)
+    
+    try:
+        offset = int(request.headers.get('Upload-Offset', request.query_params.get('offset')))
+        length = int(request.headers.get('Content-Length') or 0)
+    except (TypeError, ValueError):
+        return Response({
+            'error': 'Upload-Offset and Content-Length headers are required'
+        }, status=status.HTTP_400_BAD_REQUEST)
+    
+    # Only the next expected byte can be written; the client resumes from here
+    if offset != session.offset:
+        return Response({
+            'error': 'Offset does not match the bytes received so far',
+            'offset': session.offset
+        }, status=status.HTTP_409_CONFLICT)
+    
+    if length <= 0 or offset + length > session.size:
+        return Response({
+            'error': 'Chunk is empty or extends past the declared size',
+            'offset': session.offset
+        }, status=status.HTTP_400_BAD_REQUEST)
+    
+    if length > settings.CHUNKED_UPLOAD_MAX_CHUNK_SIZE:
+        return Response({
+            'error': f'Chunk too large, limit is {settings.CHUNKED_UPLOAD_MAX_CHUNK_SIZE} bytes',
+            'offset': session.offset
+        }, status=status.HTTP_413_REQUEST_ENTITY_TOO_LARGE)
+    
+    expected = request.headers.get('X-Chunk-SHA256', '').lower()
+    if not expected:
+        return Response({
+            'error': 'X-Chunk-SHA256 header is required'
+        }, status=status.HTTP_400_BAD_REQUEST)
+    
+    # Receive into a separate file first; only a verified chunk touches the part file
+    digest = hashlib.sha256()
+    written = 0
+    chunk_path = f'{_chunk_path(session)}.{uuid.uuid4().hex}.chunk'
+    try:
+        with open(chunk_path, 'w+b') as chunk:
+            while written < length:
+                data = request.stream.read(min(64 * 1024, length - written))
+                if not data:
+                    break
+                chunk.write(data)
+                digest.update(data)
+                written += len(data)
             
-            if not dets or dets == "Failed to fetch results":
+            if written != length or digest.hexdigest() != expected:
                 return Response({
-                    'error': f'Detection API failed for {filename}. Make sure the detection server is running on localhost:5000'
-                }, status=status.HTTP_503_SERVICE_UNAVAILABLE)
-            
-            # Path to save annotated image
-            f_path = os.path.normpath(
-                BASE_DIR + "/media/whitefly_results/" + os.path.basename(instance.images.url)
-            )
-            
-            # Create directory if it doesn't exist
-            os.makedirs(os.path.dirname(f_path), exist_ok=True)
-            
-            # Draw annotations and save
-            annotated_img = draw_annotations(bin_data, dets[0]['result'])
-            save_img(annotated_img, f_path)
+                    'error': 'Chunk incomplete or checksum mismatch, resend it',
+                    'offset': offset
+                }, status=status.HTTP_400_BAD_REQUEST)
             
-            # Save results to CSV
-            save_results(f.name, len(dets[0]['result']), csv_dir)
-            
-            # Save results to database
-            results_instance = Result(
-                image=instance, 
-                annotated_coordinates=dets[0]['result']
+            # A retried PUT may have been received alongside this one; the lock
+            # makes the offset check and the append one step
+            with _locked_part(session) as part:
+                current = UploadSession.objects.filter(pk=session.pk).values('offset', 'status').first()
+                if current is None or current['status'] != UploadSession.STATUS_UPLOADING or current['offset'] != offset:
+                    return Response({
+                        'error': 'Upload changed while receiving the chunk',
+                        'offset': current['offset'] if current else offset
+                    }, status=status.HTTP_409_CONFLICT)
+                
+                chunk.seek(0)
+                part.seek(offset)
+                part.truncate()  # Drop anything past the verified bytes
+                shutil.copyfileobj(chunk, part)
+                part.flush()
+                os.fsync(part.fileno())
+                
+                UploadSession.objects.filter(pk=session.pk).update(
+                    offset=offset + length, last_modified=timezone.now()
+                )
+    finally:
+        if os.path.exists(chunk_path):
+            os.remove(chunk_path)
+    
+    return Response({
+        'upload_id': str(session.id),
+        'offset': offset + length,
+        'size': session.size
+    })
+
+
+@api_view(['POST'])
+@permission_classes([IsAuthenticated])
+def upload_complete_view(request, upload_id):
+    """Verify a fully received upload and run detection on it"""
+    session, error_response = _get_upload_session(request, upload_id)
+    if error_response is not None:
+        return error_response
+    
+    # Safe to repeat if the first response was lost on the way back
+    if session.status == UploadSession.STATUS_COMPLETE:
+        return Response(_session_payload(session))
+    if session.status == UploadSession.STATUS_REJECTED:
+        return Response({
+            **_session_payload(session),
+            'error': f'{session.filename} was rejected (not a readable image or failed the quality check) and was not processed'
+        }, status=status.HTTP_422_UNPROCESSABLE_ENTITY)
+    
+    if session.offset != session.size:
+        return Response({
+            'error': 'Upload is not complete',
+            'offset': session.offset
+        }, status=status.HTTP_409_CONFLICT)
+    
+    # Claim the session so a repeated complete cannot run detection twice
+    claimed = UploadSession.objects.filter(
+        pk=session.pk, status=UploadSession.STATUS_UPLOADING, offset=session.size
+    ).update(status=UploadSession.STATUS_PROCESSING, last_modified=timezone.now())
+    if not claimed:
+        return Response({
+            'error': 'Upload is already being processed'
+        }, status=status.HTTP_409_CONFLICT)
+    
+    path = _chunk_path(session)
+    with open(path, 'rb') as part:
+        bin_data = part.read()
+    
+    if session.sha256 and hashlib.sha256(bin_data).hexdigest() != session.sha256:
+        # The file is corrupt somewhere; start over rather than guess where
+        with _locked_part(session) as part:
+            part.truncate(0)
+            UploadSession.objects.filter(pk=session.pk).update(
+                offset=0, status=UploadSession.STATUS_UPLOADING, last_modified=timezone.now()
             )
-            results_instance.save()
-            
-            # Prepare response data
-            results.append({
-                'image_id': instance.id,
-                'result_id': results_instance.id,
-                'image_name': filename,
-                'whitefly_count': len(dets[0]['result']),
-                'annotated_image_url': f'/media/whitefly_results/{os.path.basename(instance.images.url)}',
-                'original_image_url': instance.images.url
-            })
-            
-        except Exception as e:
-            import traceback
-            error_details = traceback.format_exc()
-            print(f"Error processing {filename}: {error_details}")
-            return Response({
-                'error': f'Error processing {filename}: {str(e)}'
-            }, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
+        return Response({
+            'error': 'File checksum mismatch, upload it again',
+            'offset': 0
+        }, status=status.HTTP_400_BAD_REQUEST)
+    
+    size, error_response = _read_size(session.filename, bin_data)
+    if error_response is not None:
+        # The bytes arrived intact but are not an image; retrying cannot help
+        os.remove(path)
+        session.status = UploadSession.STATUS_REJECTED
+        session.save(update_fields=['status', 'last_modified'])
+        return Response({
+            **_session_payload(session),
+            **error_response.data
+        }, status=status.HTTP_400_BAD_REQUEST)
+    width, height = size
+    
+    quality, rejected = _check_quality(session.filename, bin_data)
+    if rejected is not None:
+        # Retrying cannot fix the image, so the data is dropped
+        os.remove(path)
+        session.status = UploadSession.STATUS_REJECTED
+        session.save(update_fields=['status', 'last_modified'])
+        return Response({
+            **_session_payload(session),
+            **rejected
+        }, status=status.HTTP_422_UNPROCESSABLE_ENTITY)
+    
+    boxes, error_response = _detect(request.user, session.filename, session.filename, bin_data)
+    if error_response is not None:
+        # Keep the data so the client can retry complete later
+        UploadSession.objects.filter(pk=session.pk).update(status=UploadSession.STATUS_UPLOADING)
+        return error_response
+    
+    try:
+        instance = _stored_image(
+            ContentFile(bin_data), request.user, session.filename, width, height, quality
+        )
+        try:
+            with stage('db_write'), transaction.atomic():
+                instance.save()
+                
+                results_instance = Result(
+                    image=instance, 
+                    annotated_coordinates=boxes
+                )
+                results_instance.save()
+                
+                session.status = UploadSession.STATUS_COMPLETE
+                session.result = results_instance
+                session.save()
+        except Exception:
+            _discard_files([instance])
+            raise
+        
+        os.remove(path)
+        payload = _render_result(instance, results_instance, session.filename, bin_data, boxes)
+    except Exception as e:
+        error_details = traceback.format_exc()
+        print(f"Error processing {session.filename}: {error_details}")
+        # Only reopen the session if the transaction above did not commit
+        UploadSession.objects.filter(
+            pk=session.pk, status=UploadSession.STATUS_PROCESSING
+        ).update(status=UploadSession.STATUS_UPLOADING)
+        return Response({
+            'error': f'Error processing {session.filename}: {str(e)}'
+        }, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
     
     return Response({
-        'message': f'Successfully processed {len(results)} image(s)',
-        'results': results
-    }, status=status.HTTP_200_OK)
+        **_session_payload(session),
+        'result': payload
+    })
 
 
 @api_view(['GET'])
 @permission_classes([IsAuthenticated])
+@cached_api_response(
+    'images',
+    lambda request: Image.objects.filter(user=request.user).aggregate(m=Max('last_modified'))['m'],
+)
 def get_user_images_view(request):
     """Get all images uploaded by current user"""
-    images = Image.objects.filter(user=request.user).order_by('-upload_date')
+    images = Image.objects.filter(user=request.user).select_related('user').order_by('-upload_date')
     serializer = ImageSerializer(images, many=True)
-    return Response(serializer.data)
+    with stage('serialize'):
+        data = serializer.data
+    return Response(data)
 
 
 @api_view(['GET'])
 @permission_classes([IsAuthenticated])
+@cached_api_response(
+    'results',
+    lambda request: Result.objects.filter(image__user=request.user).aggregate(m=Max('last_modified'))['m'],
+)
 def get_user_results_view(request):
     """Get all detection results for current user"""
     results = Result.objects.filter(
         image__user=request.user
-    ).order_by('-upload_date')
+    ).select_related('image__user').order_by('-upload_date')
     serializer = ResultSerializer(results, many=True)
-    return Response(serializer.data)
+    with stage('serialize'):
+        data = serializer.data
+    return Response(data)
 
 
 @api_view(['GET'])
 @permission_classes([IsAuthenticated])
+@cached_api_response(
+    'result_detail',
+    lambda request, result_id: Result.objects.filter(
+        id=result_id, image__user=request.user
+    ).aggregate(m=Max('last_modified'))['m'],
+)
 def get_result_detail_view(request, result_id):
     """Get specific result details"""
     try:
-        result = Result.objects.get(id=result_id, image__user=request.user)
+        result = Result.objects.select_related('image__user').get(id=result_id, image__user=request.user)
         serializer = ResultSerializer(result)
         return Response(serializer.data)
     except Result.DoesNotExist:
         return Response({
             'error': 'Result not found'
         }, status=status.HTTP_404_NOT_FOUND)
+
+
+def _image_size(image):
+    """Pixel size of an Image, read from the file header for older rows (None if unreadable)"""
+    if image.width and image.height:
+        return image.width, image.height
+    try:
+        with open(image.original_path(), 'rb') as f:
+            width, height = get_image_size(f.read())
+    except Exception:
+        # Legacy row whose original is missing or not an image
+        return None
+    # update() skips signals, so the cached API responses stay valid
+    Image.objects.filter(pk=image.pk).update(width=width, height=height)
+    image.width, image.height = width, height
+    return width, height
+
+
+@api_view(['GET'])
+@permission_classes([IsAuthenticated])
+@cached_api_response(
+    'result_heatmap',
+    lambda request, result_id: Result.objects.filter(
+        id=result_id, image__user=request.user
+    ).aggregate(m=Max('last_modified'))['m'],
+)
+def result_heatmap_view(request, result_id):
+    """Density heatmap overlay and cluster statistics for one result"""
+    from .analysis import analyze_detections, render_heatmap
+    
+    try:
+        result = Result.objects.select_related('image').get(id=result_id, image__user=request.user)
+    except Result.DoesNotExist:
+        return Response({
+            'error': 'Result not found'
+        }, status=status.HTTP_404_NOT_FOUND)
+    
+    image = result.image
+    size = _image_size(image)
+    if size is None:
+        return Response({
+            'error': f'The original of {image.name or basename(image.images.name)} is missing or unreadable, '
+                     'so its heatmap cannot be drawn'
+        }, status=status.HTTP_409_CONFLICT)
+    width, height = size
+    grid, stats = analyze_detections(
+        result.annotated_coordinates, width, height,
+        settings.HEATMAP_BINS, settings.HEATMAP_SIGMA, settings.HEATMAP_CLUSTER_THRESHOLD,
+    )
+    
+    # Heatmap sits next to the annotated image in media/whitefly_results
+    heatmap_name = 'heatmap_' + os.path.basename(image.images.name)
+    f_path = annotated_image_path(heatmap_name)
+    os.makedirs(os.path.dirname(f_path), exist_ok=True)
+    
+    try:
+        with open(image.original_path(), 'rb') as f:
+            background = decode_image(f.read())
+    except Exception:
+        # The size is known, so the heatmap can still be drawn on its own
+        background = None
+    save_img(render_heatmap(grid, (width, height), background), f_path)
+    
+    return Response({
+        'result_id': result.id,
+        'image_id': image.id,
+        'whitefly_count': stats['detections'],
+        'heatmap_image_url': f'/media/whitefly_results/{heatmap_name}',
+        'stats': stats,
+    })
+
+
+@api_view(['GET'])
+@permission_classes([IsAuthenticated])
+@cached_api_response(
+    'user_density',
+    lambda request: Result.objects.filter(image__user=request.user).aggregate(m=Max('last_modified'))['m'],
+    query_params=('grid',),
+)
+def user_density_view(request):
+    """Detection density and clusters across all of the user's images (normalized 0-1 coordinates)"""
+    from .analysis import analyze_many
+    
+    results = Result.objects.filter(image__user=request.user).select_related('image')
+    
+    rows = []
+    skipped = 0
+    for result in results.iterator():
+        size = _image_size(result.image)
+        if size is None:
+            skipped += 1
+            continue
+        rows.append((result.annotated_coordinates, *size))
+    
+    grid, stats = analyze_many(
+        rows, settings.HEATMAP_BINS, settings.HEATMAP_SIGMA, settings.HEATMAP_CLUSTER_THRESHOLD,
+    )
+    
+    return Response({
+        'image_count': len(rows),
+        'skipped_count': skipped,  # Images whose size could not be read
+        'grid': grid.round(4).tolist() if request.query_params.get('grid') == 'true' else None,
+        'stats': stats,
+    })
+
+
+def _iter_file_range(path, start, length):
+    with open(path, 'rb') as f:
+        f.seek(start)
+        while length > 0:
+            data = f.read(min(64 * 1024, length))
+            if not data:
+                break
+            length -= len(data)
+            yield data
+
+
+def _archive_response(path, range_header, etag, filename):
+    """Serve a cached archive, honouring a single "bytes=" Range for resumed downloads"""
+    size = os.path.getsize(path)
+    start, end = 0, size - 1
+    partial = False
+    
+    match = re.fullmatch(r'bytes=(\d*)-(\d*)', (range_header or '').strip())
+    if match and (match.group(1) or match.group(2)):
+        if match.group(1):
+            start = int(match.group(1))
+            end = min(int(match.group(2)), size - 1) if match.group(2) else size - 1
+        else:
+            # Suffix range: the last N bytes
+            start = max(size - int(match.group(2)), 0)
+        if start >= size or start > end:
+            response = HttpResponse(status=status.HTTP_416_REQUESTED_RANGE_NOT_SATISFIABLE)
+            response['Content-Range'] = f'bytes */{size}'
+            return response
+        partial = True
+    
+    response = StreamingHttpResponse(
+        _iter_file_range(path, start, end - start + 1),
+        content_type='application/zip',
+        status=status.HTTP_206_PARTIAL_CONTENT if partial else status.HTTP_200_OK
+    )
+    if partial:
+        response['Content-Range'] = f'bytes {start}-{end}/{size}'
+    response['Content-Length'] = str(end - start + 1)
+    response['Content-Disposition'] = f'attachment; filename="{filename}"'
+    response['Accept-Ranges'] = 'bytes'
+    response['ETag'] = etag
+    return response
+
+
+@api_view(['GET'])
+@permission_classes([IsAuthenticated])
+def export_view(request):
+    """Stream a ZIP of the user's originals, annotated images and box manifests (?from=&to= dates)"""
+    date_from = request.query_params.get('from')
+    date_to = request.query_params.get('to')
+    try:
+        parsed_from = parse_date(date_from) if date_from else None
+        parsed_to = parse_date(date_to) if date_to else None
+    except ValueError:
+        parsed_from = parsed_to = None
+    if (date_from and parsed_from is None) or (date_to and parsed_to is None):
+        return Response({
+            'error': 'from and to must be dates (YYYY-MM-DD)'
+        }, status=status.HTTP_400_BAD_REQUEST)
+    
+    results = Result.objects.filter(image__user=request.user).select_related('image').order_by('id')
+    if parsed_from:
+        results = results.filter(image__upload_date__date__gte=parsed_from)
+    if parsed_to:
+        results = results.filter(image__upload_date__date__lte=parsed_to)
+    
+    # Any upload, edit or delete in the range gives the archive a new identity
+    summary = results.aggregate(
+        n=Count('id'), newest=Max('last_modified'), newest_image=Max('image__last_modified')
+    )
+    key = hashlib.sha256(
+        f"{request.user.pk}:{parsed_from}:{parsed_to}:{summary['n']}:{summary['newest']}:{summary['newest_image']}".encode()
+    ).hexdigest()[:32]
+    etag = quote_etag(key)
+    cache_path = os.path.join(settings.EXPORT_CACHE_DIR, f'{key}.zip')
+    filename = f'whitefly_export_{request.user.username}_{timezone.now():%Y%m%d}.zip'
+    
+    if os.path.exists(cache_path):
+        # If-Range: only resume if the client's partial copy is this same archive
+        if_range = request.headers.get('If-Range')
+        range_header = request.headers.get('Range') if not if_range or if_range == etag else None
+        return _archive_response(cache_path, range_header, etag, filename)
+    
+    purge_export_cache()
+    response = StreamingHttpResponse(
+        iter_export_zip(results, cache_path), content_type='application/zip'
+    )
+    response['Content-Disposition'] = f'attachment; filename="{filename}"'
+    response['Accept-Ranges'] = 'bytes'
+    response['ETag'] = etag
+    return response
@@ -4,3 +4,11 @@ from django.apps import AppConfig
 class WhiteflyConfig(AppConfig):
     default_auto_field = 'django.db.models.BigAutoField'
     name = 'whitefly'
+
+    def ready(self):
+        from . import signals  # noqa: F401
+
+        from django.conf import settings
+        if settings.PRELOAD_IMAGE_STACK:
+            from .utilities import preload_image_stack
+            preload_image_stack()
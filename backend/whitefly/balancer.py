@@ -0,0 +1,290 @@
+"""Routing of detection requests across a pool of detection API endpoints.
+
+Endpoints come from ``settings.DETECTION_API_URLS``. Requests go to the
+endpoint with the fewest requests in flight, counted across all gunicorn
+workers on the host through ``DETECTION_POOL_STORE`` (or by smooth weighted
+round-robin). Each worker ejects endpoints that keep failing, and a background
+thread per worker probes ``/health`` to bring them back.
+"""
+import os
+import threading
+import time
+
+from django.conf import settings
+from prometheus_client import Counter, Gauge, Histogram
+
+from .admission import SharedStore, _pid_alive
+
+
+DETECTION_LATENCY = Histogram(
+    'whitefly_detection_request_seconds',
+    'Detection API request latency',
+    ['endpoint'],
+    buckets=(0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60),
+)
+
+DETECTION_ERRORS = Counter(
+    'whitefly_detection_errors_total',
+    'Failed detection API requests',
+    ['endpoint', 'kind'],
+)
+
+DETECTION_HEALTHY = Gauge(
+    'whitefly_detection_endpoint_healthy',
+    'Whether a detection endpoint is in rotation (1) or ejected (0)',
+    ['endpoint'],
+)
+
+DETECTION_OUTSTANDING = Gauge(
+    'whitefly_detection_outstanding_requests',
+    'Detection requests currently in flight',
+    ['endpoint'],
+)
+
+
+class Endpoint:
+    def __init__(self, url, weight=1):
+        self.url = url.rstrip('/')
+        self.weight = max(1, weight)
+        self.healthy = True
+        self.outstanding = 0
+        self.failures = 0  # Consecutive failed requests
+        self.current_weight = 0  # Smooth weighted round-robin state
+        DETECTION_HEALTHY.labels(self.url).set(1)
+
+    def __repr__(self):
+        return f'<Endpoint {self.url} weight={self.weight} healthy={self.healthy}>'
+
+
+def parse_endpoints(value):
+    """'http://a:5000=2,http://b:5000' -> [Endpoint(a, weight 2), Endpoint(b)]"""
+    endpoints = []
+    for item in value.split(','):
+        item = item.strip()
+        if not item:
+            continue
+        url, _, weight = item.partition('=')
+        endpoints.append(Endpoint(url, int(weight) if weight else 1))
+    return endpoints
+
+
+class OutstandingStore(SharedStore):
+    """Detection requests in flight per endpoint, shared by all workers on the host"""
+
+    def __init__(self, path, ttl=600):
+        super().__init__(path)
+        self.ttl = ttl
+        with self._transaction() as db:
+            db.execute(
+                'CREATE TABLE IF NOT EXISTS detection_outstanding ('
+                'id INTEGER PRIMARY KEY, endpoint TEXT, pid INTEGER, started REAL)'
+            )
+
+    def _purge(self, db):
+        """Drop requests left behind by crashed or killed workers"""
+        db.execute('DELETE FROM detection_outstanding WHERE started < ?', (time.time() - self.ttl,))
+        pids = [row[0] for row in db.execute('SELECT DISTINCT pid FROM detection_outstanding')]
+        for pid in pids:
+            if not _pid_alive(pid):
+                db.execute('DELETE FROM detection_outstanding WHERE pid = ?', (pid,))
+
+    def claim(self, choose):
+        """Pick an endpoint with ``choose(counts by url)`` and record a request on it, atomically.
+
+        Returns (endpoint, ticket); pass the ticket to release().
+        """
+        with self._transaction() as db:
+            self._purge(db)
+            counts = dict(db.execute('SELECT endpoint, COUNT(*) FROM detection_outstanding GROUP BY endpoint'))
+            endpoint = choose(counts)
+            ticket = db.execute(
+                'INSERT INTO detection_outstanding (endpoint, pid, started) VALUES (?, ?, ?)',
+                (endpoint.url, os.getpid(), time.time()),
+            ).lastrowid
+        return endpoint, ticket
+
+    def release(self, ticket):
+        with self._transaction() as db:
+            db.execute('DELETE FROM detection_outstanding WHERE id = ?', (ticket,))
+
+
+class DetectionPool:
+    def __init__(self, endpoints, policy='least_outstanding', max_failures=3,
+                 health_interval=10, timeout=60, store=None):
+        if not endpoints:
+            raise ValueError('DetectionPool needs at least one endpoint')
+        self.endpoints = endpoints
+        self.policy = policy
+        # Without a store, least_outstanding only sees this process's requests
+        self.store = store
+        self.max_failures = max_failures
+        self.health_interval = health_interval
+        self.timeout = timeout
+        self._lock = threading.Lock()
+        self._session = None
+        self._health_thread = None
+        self._rotation = 0
+
+    @property
+    def session(self):
+        # One keep-alive session per pool; requests is only imported when used
+        if self._session is None:
+            import requests
+            self._session = requests.Session()
+        return self._session
+
+    def _candidates(self, exclude):
+        healthy = [e for e in self.endpoints if e.healthy and e not in exclude]
+        if healthy:
+            return healthy
+        # Everything is ejected: fail open rather than refuse all work
+        return [e for e in self.endpoints if e not in exclude]
+
+    def acquire(self, exclude=()):
+        """Pick an endpoint and count the request as outstanding on it.
+
+        Returns (endpoint, ticket), or (None, None) when every endpoint was excluded.
+        """
+        with self._lock:
+            candidates = self._candidates(exclude)
+            if not candidates:
+                return None, None
+
+            ticket = None
+            if self.policy == 'weighted_round_robin':
+                total = sum(e.weight for e in candidates)
+                for e in candidates:
+                    e.current_weight += e.weight
+                endpoint = max(candidates, key=lambda e: e.current_weight)
+                endpoint.current_weight -= total
+            else:
+                # Rotate the starting point so ties do not always go to the first endpoint
+                self._rotation = (self._rotation + 1) % len(candidates)
+                candidates = candidates[self._rotation:] + candidates[:self._rotation]
+                if self.store is None:
+                    endpoint = min(candidates, key=lambda e: e.outstanding / e.weight)
+                else:
+                    endpoint, ticket = self.store.claim(
+                        lambda counts: min(candidates, key=lambda e: counts.get(e.url, 0) / e.weight)
+                    )
+
+            endpoint.outstanding += 1
+            DETECTION_OUTSTANDING.labels(endpoint.url).inc()
+            return endpoint, ticket
+
+    def release(self, endpoint, ok, kind=None, ticket=None):
+        if ticket is not None:
+            self.store.release(ticket)
+        with self._lock:
+            endpoint.outstanding -= 1
+            DETECTION_OUTSTANDING.labels(endpoint.url).dec()
+            if ok:
+                endpoint.failures = 0
+                return
+            DETECTION_ERRORS.labels(endpoint.url, kind or 'error').inc()
+            endpoint.failures += 1
+            if endpoint.healthy and endpoint.failures >= self.max_failures:
+                self._set_healthy(endpoint, False)
+
+    def _set_healthy(self, endpoint, healthy):
+        if endpoint.healthy != healthy:
+            print(f"Detection endpoint {endpoint.url} {'restored' if healthy else 'ejected'}")
+        endpoint.healthy = healthy
+        if healthy:
+            endpoint.failures = 0
+        DETECTION_HEALTHY.labels(endpoint.url).set(1 if healthy else 0)
+
+    def post(self, path, files):
+        """POST files to path on a pool endpoint, failing over on connection errors and 5xx.
+
+        Returns the ``requests`` response, or raises the last connection error.
+        """
+        self.start_health_checks()
+        tried = []
+        last_error = None
+        last_response = None
+        for _ in range(len(self.endpoints)):
+            endpoint, ticket = self.acquire(exclude=tried)
+            if endpoint is None:
+                break
+            tried.append(endpoint)
+
+            start = time.perf_counter()
+            try:
+                r = self.session.post(url=endpoint.url + path, files=files, timeout=self.timeout)
+            except Exception as e:
+                self.release(endpoint, ok=False, kind='connection', ticket=ticket)
+                last_error = e
+                continue
+            finally:
+                DETECTION_LATENCY.labels(endpoint.url).observe(time.perf_counter() - start)
+
+            if r.status_code >= 500:
+                self.release(endpoint, ok=False, kind=f'http_{r.status_code}', ticket=ticket)
+                last_error = None
+                last_response = r
+                continue
+            self.release(endpoint, ok=True, ticket=ticket)
+            return r
+
+        if last_error is not None:
+            raise last_error
+        return last_response
+
+    def check_health(self):
+        """Probe /health on every endpoint once"""
+        import requests
+
+        for endpoint in self.endpoints:
+            try:
+                # Plain requests.get: the shared session belongs to request threads
+                r = requests.get(endpoint.url + '/health', timeout=min(5, self.timeout))
+                healthy = r.status_code == 200
+            except Exception:
+                healthy = False
+            with self._lock:
+                if healthy:
+                    self._set_healthy(endpoint, True)
+                elif endpoint.healthy:
+                    DETECTION_ERRORS.labels(endpoint.url, 'health').inc()
+                    self._set_healthy(endpoint, False)
+
+    def start_health_checks(self):
+        """Start the background prober (once per process, after any fork)"""
+        if self._health_thread is not None or self.health_interval <= 0:
+            return
+        with self._lock:
+            if self._health_thread is not None:
+                return
+
+            def run():
+                while True:
+                    time.sleep(self.health_interval)
+                    self.check_health()
+
+            self._health_thread = threading.Thread(target=run, name='detection-health', daemon=True)
+            self._health_thread.start()
+
+
+_pool = None
+_pool_lock = threading.Lock()
+
+
+def get_pool():
+    """The detection pool for this process, built from settings on first use"""
+    global _pool
+    if _pool is None:
+        with _pool_lock:
+            if _pool is None:
+                store = None
+                if settings.DETECTION_ROUTING == 'least_outstanding' and settings.DETECTION_POOL_STORE:
+                    store = OutstandingStore(settings.DETECTION_POOL_STORE)
+                _pool = DetectionPool(
+                    parse_endpoints(settings.DETECTION_API_URLS),
+                    policy=settings.DETECTION_ROUTING,
+                    max_failures=settings.DETECTION_MAX_FAILURES,
+                    health_interval=settings.DETECTION_HEALTH_INTERVAL,
+                    timeout=settings.DETECTION_TIMEOUT,
+                    store=store,
+                )
+    return _pool
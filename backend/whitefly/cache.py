@@ -0,0 +1,120 @@
+import hashlib
+import json
+import time
+from functools import wraps
+from urllib.parse import urlencode
+
+from django.conf import settings
+from django.core.cache import cache
+from django.core.serializers.json import DjangoJSONEncoder
+from django.utils.cache import get_conditional_response, patch_vary_headers
+from django.utils.http import http_date, quote_etag
+from prometheus_client import Counter
+from rest_framework.response import Response
+
+
+API_CACHE_REQUESTS = Counter(
+    'whitefly_api_cache_requests_total',
+    'Per-user API response cache lookups',
+    ['endpoint', 'result'],
+)
+
+API_CACHE_NOT_MODIFIED = Counter(
+    'whitefly_api_cache_not_modified_total',
+    'API responses answered with 304 Not Modified',
+    ['endpoint'],
+)
+
+
+def _version_key(user_id):
+    return f'whitefly:api:{user_id}:changed'
+
+
+def get_user_version(user_id):
+    """Timestamp of the last change to a user's images/results.
+
+    A missing version (never set, or culled by the cache backend) starts
+    again from now, so entries cached under an earlier version are never
+    reused.
+    """
+    key = _version_key(user_id)
+    version = cache.get(key)
+    if version is None:
+        now = time.time()
+        # add() keeps the value of a worker that set it first
+        cache.add(key, now, None)
+        version = cache.get(key, now)
+    return version
+
+
+def invalidate_user_cache(user_id):
+    """Drop every cached API response for a user by moving to a new version"""
+    if user_id is None:
+        return
+    # Entries for older versions are never read again and expire on their own
+    cache.set(_version_key(user_id), time.time(), None)
+
+
+def cached_api_response(endpoint, last_modified_func=None, query_params=()):
+    """Cache a GET view's response data per user and answer conditional requests.
+
+    ``last_modified_func(request, **kwargs)`` returns the newest
+    ``last_modified`` datetime behind the response; it only runs on a miss.
+    ``query_params`` names the query parameters the view reads; others are
+    left out of the cache key.
+    """
+    def decorator(view_func):
+        @wraps(view_func)
+        def wrapper(request, *args, **kwargs):
+            user_id = request.user.pk
+            version = get_user_version(user_id)
+            params = ':'.join(f'{k}={v}' for k, v in sorted(kwargs.items()))
+            used = sorted((name, request.GET.getlist(name)) for name in query_params if name in request.GET)
+            if used:
+                params += '?' + urlencode(used, doseq=True)
+            key = f'whitefly:api:{user_id}:{version}:{endpoint}:{params}'
+
+            entry = cache.get(key)
+            if entry is None:
+                API_CACHE_REQUESTS.labels(endpoint, 'miss').inc()
+                response = view_func(request, *args, **kwargs)
+                if response.status_code != 200:
+                    return response
+
+                body = json.dumps(response.data, sort_keys=True, cls=DjangoJSONEncoder)
+                last_modified = None
+                if last_modified_func is not None:
+                    newest = last_modified_func(request, **kwargs)
+                    if newest is not None:
+                        last_modified = int(newest.timestamp())
+                # Deletions do not show up in last_modified, the version does
+                last_modified = max(last_modified or 0, int(version))
+
+                entry = {
+                    'data': response.data,
+                    'etag': quote_etag(hashlib.md5(body.encode()).hexdigest()),
+                    'last_modified': last_modified,
+                }
+                cache.set(key, entry, settings.API_CACHE_TIMEOUT)
+            else:
+                API_CACHE_REQUESTS.labels(endpoint, 'hit').inc()
+                response = None
+
+            not_modified = get_conditional_response(
+                request, etag=entry['etag'], last_modified=entry['last_modified']
+            )
+            if not_modified is not None:
+                API_CACHE_NOT_MODIFIED.labels(endpoint).inc()
+                response = not_modified
+            elif response is None:
+                response = Response(entry['data'])
+
+            response['ETag'] = entry['etag']
+            if entry['last_modified'] is not None:
+                response['Last-Modified'] = http_date(entry['last_modified'])
+            # Per-user data: browsers may keep it but must revalidate first
+            response['Cache-Control'] = 'private, no-cache'
+            patch_vary_headers(response, ('Cookie',))
+            return response
+        return wrapper
+    return decorator
@@ -0,0 +1,185 @@
+"""Streaming ZIP export of a user's images, annotated images and detection manifests.
+
+The archive is produced by a generator: ``zipfile`` writes into a small buffer
+that is drained after every piece, so neither memory nor the response ever
+holds the whole archive. The same bytes are teed into a cache file which,
+once complete, serves HTTP range requests for resumed downloads.
+"""
+import csv
+import io
+import json
+import os
+import time
+import uuid
+import zipfile
+
+from django.conf import settings
+
+from .utilities import ensure_annotated_image
+
+
+READ_SIZE = 64 * 1024
+
+
+class _StreamBuffer(io.RawIOBase):
+    """Unseekable sink for ZipFile; collects bytes until the generator drains them"""
+
+    def __init__(self, tee=None):
+        self._chunks = []
+        self._tee = tee
+        self._position = 0
+
+    def writable(self):
+        return True
+
+    def write(self, data):
+        data = bytes(data)
+        self._chunks.append(data)
+        if self._tee is not None:
+            self._tee.write(data)
+        self._position += len(data)
+        return len(data)
+
+    def tell(self):
+        # ZipFile needs the offset of each entry, even on unseekable streams
+        return self._position
+
+    def drain(self):
+        data = b''.join(self._chunks)
+        self._chunks = []
+        return data
+
+
+def _date_time(value):
+    # ZIP timestamps cannot predate 1980
+    if value is None or value.year < 1980:
+        return (1980, 1, 1, 0, 0, 0)
+    return value.timetuple()[:6]
+
+
+def _box_rows(result):
+    for d in result.annotated_coordinates or []:
+        for index, c in d.items():
+            yield index, c.get('xmin'), c.get('ymin'), c.get('xmax'), c.get('ymax')
+
+
+def iter_export_zip(results, tee_path=None):
+    """Yield the bytes of a ZIP with originals/, annotated/, manifest.csv and manifest.json.
+
+    ``results`` is a Result queryset with ``image`` selected. When ``tee_path``
+    is given the archive is also written there; if the client disconnects the
+    archive is still finished into the cache, so the download can resume with
+    a Range request.
+    """
+    chunks = _build_zip(results, tee_path)
+    try:
+        for chunk in chunks:
+            if chunk:
+                yield chunk
+    except GeneratorExit:
+        if tee_path is not None:
+            for _ in chunks:
+                pass
+        raise
+
+
+def _build_zip(results, tee_path):
+    tee = None
+    part_path = None
+    if tee_path is not None:
+        os.makedirs(os.path.dirname(tee_path), exist_ok=True)
+        part_path = f'{tee_path}.{uuid.uuid4().hex}.part'
+        tee = open(part_path, 'wb')
+
+    completed = False
+    try:
+        stream = _StreamBuffer(tee)
+        with zipfile.ZipFile(stream, 'w', compression=zipfile.ZIP_STORED) as archive:
+            for result in results.iterator():
+                image = result.image
+                when = _date_time(image.upload_date)
+                prefix = f'{image.id}_'
+                original = image.original_path()
+                sources = [('originals/' + prefix + os.path.basename(image.images.name), original)]
+                if os.path.exists(original):
+                    # Retention may have dropped the annotated copy; draw it again from the boxes
+                    annotated = ensure_annotated_image(image.images.url, original, result.annotated_coordinates)
+                    sources.append(('annotated/' + prefix + os.path.basename(image.images.url), annotated))
+                for arcname, path in sources:
+                    if not os.path.exists(path):
+                        continue
+                    # JPEG/PNG are already compressed, so entries are stored as-is
+                    info = zipfile.ZipInfo(arcname, date_time=when)
+                    with open(path, 'rb') as src, archive.open(info, 'w', force_zip64=True) as dest:
+                        while True:
+                            data = src.read(READ_SIZE)
+                            if not data:
+                                break
+                            dest.write(data)
+                            yield stream.drain()
+                yield stream.drain()
+
+            info = zipfile.ZipInfo('manifest.csv', date_time=time.localtime()[:6])
+            info.compress_type = zipfile.ZIP_DEFLATED
+            with archive.open(info, 'w', force_zip64=True) as dest:
+                text = io.TextIOWrapper(dest, encoding='utf-8', newline='')
+                writer = csv.writer(text)
+                writer.writerow([
+                    'image_id', 'result_id', 'image_name', 'upload_date', 'whitefly_count',
+                    'box_id', 'xmin', 'ymin', 'xmax', 'ymax'
+                ])
+                for result in results.iterator():
+                    base = [
+                        result.image_id, result.id, result.image.name,
+                        result.image.upload_date.isoformat() if result.image.upload_date else '',
+                        result.whitefly_count,
+                    ]
+                    rows = list(_box_rows(result)) or [('', '', '', '', '')]
+                    writer.writerows(base + list(row) for row in rows)
+                    text.flush()
+                    yield stream.drain()
+                text.flush()
+                text.detach()
+            yield stream.drain()
+
+            info = zipfile.ZipInfo('manifest.json', date_time=time.localtime()[:6])
+            info.compress_type = zipfile.ZIP_DEFLATED
+            with archive.open(info, 'w', force_zip64=True) as dest:
+                dest.write(b'[')
+                for n, result in enumerate(results.iterator()):
+                    entry = {
+                        'image_id': result.image_id,
+                        'result_id': result.id,
+                        'image_name': result.image.name,
+                        'upload_date': result.image.upload_date.isoformat() if result.image.upload_date else None,
+                        'whitefly_count': result.whitefly_count,
+                        'annotated_coordinates': result.annotated_coordinates,
+                    }
+                    dest.write((',' if n else '').encode() + json.dumps(entry).encode())
+                    yield stream.drain()
+                dest.write(b']')
+        # Closing the ZipFile writes the central directory
+        yield stream.drain()
+        completed = True
+    finally:
+        if tee is not None:
+            tee.close()
+            if completed:
+                os.replace(part_path, tee_path)
+            else:
+                os.remove(part_path)
+
+
+def purge_export_cache():
+    """Remove cached archives older than EXPORT_CACHE_HOURS"""
+    cache_dir = settings.EXPORT_CACHE_DIR
+    if not os.path.isdir(cache_dir):
+        return
+    cutoff = time.time() - settings.EXPORT_CACHE_HOURS * 3600
+    for name in os.listdir(cache_dir):
+        path = os.path.join(cache_dir, name)
+        try:
+            if os.path.getmtime(path) < cutoff:
+                os.remove(path)
+        except OSError:
+            pass
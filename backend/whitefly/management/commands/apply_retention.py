@@ -0,0 +1,188 @@
+import io
+import os
+import shutil
+from concurrent.futures import ThreadPoolExecutor
+from datetime import timedelta
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+from django.utils import timezone
+
+from whitefly.api_views import purge_expired_uploads
+from whitefly.cache import invalidate_user_cache
+from whitefly.models import Image, Result
+from whitefly.utilities import annotated_image_path
+
+
+def _file_size(path):
+    try:
+        return os.path.getsize(path)
+    except OSError:
+        return 0
+
+
+def _delete_derivatives(image_url, dry_run):
+    """Annotated image and heatmap of one result; both can be re-rendered from Result"""
+    reclaimed = 0
+    name = os.path.basename(image_url)
+    for path in (annotated_image_path(name), annotated_image_path('heatmap_' + name)):
+        size = _file_size(path)
+        if size and not dry_run:
+            os.remove(path)
+        reclaimed += size
+    return reclaimed
+
+
+def _recompress(path, quality, dry_run):
+    """Re-encode an original as JPEG in place; returns bytes saved, or None if missing.
+
+    The file keeps its name, even a .png one, so its URL and those of its
+    annotated image and heatmap stay valid; the media view sends it as JPEG.
+    """
+    from PIL import Image as PILImage
+
+    before = _file_size(path)
+    if not before:
+        return None
+    with PILImage.open(path) as img:
+        out = io.BytesIO()
+        # Same pixel size, so stored box coordinates still line up
+        img.convert('RGB').save(out, 'JPEG', quality=quality, optimize=True)
+    data = out.getvalue()
+    if len(data) >= before:
+        return 0
+
+    if not dry_run:
+        tmp_path = path + '.tmp'
+        with open(tmp_path, 'wb') as f:
+            f.write(data)
+        os.replace(tmp_path, path)
+    return before - len(data)
+
+
+def _copy_to_cold(path, name, dry_run):
+    """Copy an original to the cold tier; the hot copy is removed once the row says cold"""
+    size = _file_size(path)
+    if not size:
+        return 0
+    if not dry_run:
+        dest = os.path.join(settings.RETENTION_COLD_DIR, name)
+        os.makedirs(os.path.dirname(dest), exist_ok=True)
+        tmp_path = dest + '.tmp'
+        shutil.copyfile(path, tmp_path)
+        os.replace(tmp_path, dest)
+    return size
+
+
+class Command(BaseCommand):
+    help = 'Apply media retention: drop old annotated images, recompress or archive old originals'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--dry-run', action='store_true', help='Report bytes that would be reclaimed without changing anything')
+        parser.add_argument('--workers', type=int, default=4, help='Files processed in parallel')
+        parser.add_argument('--batch-size', type=int, default=200, help='Rows loaded and updated per batch')
+        parser.add_argument('--annotated-days', type=int, default=settings.RETENTION_ANNOTATED_DAYS)
+        parser.add_argument('--originals-days', type=int, default=settings.RETENTION_ORIGINALS_DAYS)
+        parser.add_argument(
+            '--originals-action', choices=['recompress', 'move', 'none'], default=settings.RETENTION_ORIGINALS_ACTION
+        )
+
+    def handle(self, *args, **options):
+        dry_run = options['dry_run']
+        self.workers = max(1, options['workers'])
+        self.batch_size = max(1, options['batch_size'])
+        now = timezone.now()
+
+        if options['originals_action'] == 'move' and not settings.RETENTION_COLD_DIR:
+            raise CommandError('RETENTION_COLD_DIR must be set to move originals')
+
+        report = []
+        if options['annotated_days'] > 0:
+            report.append(self._apply_annotated(now - timedelta(days=options['annotated_days']), dry_run))
+        if options['originals_days'] > 0 and options['originals_action'] != 'none':
+            report.append(self._apply_originals(
+                now - timedelta(days=options['originals_days']), options['originals_action'], dry_run
+            ))
+
+        if not dry_run:
+            # Abandoned resumable uploads, otherwise only removed when a new upload starts
+            purge_expired_uploads()
+
+        title = 'Retention dry run (nothing changed)' if dry_run else 'Retention applied'
+        self.stdout.write(self.style.SUCCESS(title))
+        total = 0
+        for label, files, reclaimed in report:
+            total += reclaimed
+            self.stdout.write(f'  {label:<46} {files:>7} file(s) {reclaimed / 1024 / 1024:>10.1f} MB')
+        self.stdout.write(f"  {'total reclaimed':<46} {'':>15} {total / 1024 / 1024:>10.1f} MB")
+
+    def _batches(self, queryset):
+        """Yield lists of rows by primary key range, so edits during the run are safe"""
+        last_pk = 0
+        while True:
+            batch = list(queryset.filter(pk__gt=last_pk).order_by('pk')[:self.batch_size])
+            if not batch:
+                return
+            last_pk = batch[-1].pk
+            yield batch
+
+    def _apply_annotated(self, cutoff, dry_run):
+        files = reclaimed = 0
+        results = Result.objects.filter(upload_date__lt=cutoff).select_related('image')
+        with ThreadPoolExecutor(self.workers) as pool:
+            for batch in self._batches(results):
+                for size in pool.map(lambda r: _delete_derivatives(r.image.images.url, dry_run), batch):
+                    files += 1 if size else 0
+                    reclaimed += size
+        return f'annotated older than {cutoff:%Y-%m-%d}', files, reclaimed
+
+    def _apply_originals(self, cutoff, action, dry_run):
+        files = reclaimed = 0
+        images = Image.objects.filter(upload_date__lt=cutoff, storage_tier=Image.TIER_HOT)
+        quality = settings.RETENTION_RECOMPRESS_QUALITY
+
+        def process(image):
+            try:
+                if action == 'move':
+                    return image, _copy_to_cold(image.images.path, image.images.name, dry_run)
+                return image, _recompress(image.images.path, quality, dry_run)
+            except Exception as e:
+                self.stderr.write(f'Image {image.id}: {e}')
+                return image, None
+
+        with ThreadPoolExecutor(self.workers) as pool:
+            for batch in self._batches(images):
+                changed = []
+                stale = []  # Files to delete once the batch is committed
+                for image, saved in pool.map(process, batch):
+                    if saved is None or (action == 'move' and not saved):
+                        # Failed or missing file: leave it for the next run
+                        continue
+                    if action == 'move':
+                        stale.append(image.images.path)
+                        image.storage_tier = Image.TIER_COLD
+                    else:
+                        # Also marks files that were already smaller as JPEG, so they are not retried
+                        image.storage_tier = Image.TIER_COMPRESSED
+                    if saved:
+                        files += 1
+                        reclaimed += saved
+                    changed.append(image)
+
+                if not dry_run and changed:
+                    # Database writes stay on this thread, one statement per batch
+                    with transaction.atomic():
+                        Image.objects.bulk_update(changed, ['storage_tier'])
+                    # Only now that rows point at the cold copies can the hot ones go;
+                    # a crash before this leaves a spare copy, never a dangling row
+                    for path in stale:
+                        try:
+                            os.remove(path)
+                        except OSError as e:
+                            self.stderr.write(f'Could not remove {path}: {e}')
+                    for user_id in {image.user_id for image in changed}:
+                        invalidate_user_cache(user_id)
+
+        label = 'originals moved to cold storage' if action == 'move' else 'originals recompressed'
+        return f'{label} (< {cutoff:%Y-%m-%d})', files, reclaimed
@@ -0,0 +1,148 @@
+import os
+import statistics
+import time
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+from whitefly.utilities import decode_image, post_image
+
+
+IMAGE_EXTENSIONS = ('.jpg', '.jpeg', '.png', '.bmp', '.webp')
+
+
+def _leaf(rng, width, height):
+    """Synthetic leaf photo: mottled green texture, veins and small white insects"""
+    import cv2
+    import numpy as np
+
+    # Details scale with the frame, as they would for the same leaf shot at a higher resolution
+    scale = max(1.0, max(width, height) / 1920)
+    base = cv2.resize(rng.random((height // 40, width // 40, 3)), (width, height), interpolation=cv2.INTER_CUBIC)
+    img = (np.array([40, 130, 60]) + base * np.array([30, 90, 45])).astype(np.float32)
+    img += rng.normal(0, 4, (height, width, 1))
+    for _ in range(12):
+        x1, y1, x2, y2 = rng.integers(0, width), rng.integers(0, height), rng.integers(0, width), rng.integers(0, height)
+        cv2.line(img, (int(x1), int(y1)), (int(x2), int(y2)), (90, 190, 120), int(rng.integers(2, 6) * scale))
+    for _ in range(int(rng.integers(5, 40))):
+        center = (int(rng.integers(0, width)), int(rng.integers(0, height)))
+        axes = (int(rng.integers(6, 12) * scale), int(rng.integers(3, 6) * scale))
+        cv2.ellipse(img, center, axes, float(rng.integers(0, 180)), 0, 360, (235, 240, 240), -1)
+    return np.clip(img, 0, 255).astype(np.uint8)
+
+
+VARIANTS = {
+    'good': lambda img, cv2: img,
+    'blurred': lambda img, cv2: cv2.GaussianBlur(img, (0, 0), max(img.shape) / 240),
+    'overexposed': lambda img, cv2: cv2.convertScaleAbs(img, alpha=2.5, beta=120),
+    'underexposed': lambda img, cv2: cv2.convertScaleAbs(img, alpha=0.08),
+    'blank': lambda img, cv2: img * 0 + 128,
+    'tiny': lambda img, cv2: cv2.resize(img, (240, 180), interpolation=cv2.INTER_AREA),
+}
+
+
+def _synthetic_set(count, good_share, width, height, seed):
+    """(label, JPEG bytes) pairs; ``good_share`` of them are usable photos"""
+    import cv2
+    import numpy as np
+
+    rng = np.random.default_rng(seed)
+    bad = [name for name in VARIANTS if name != 'good']
+    samples = []
+    for n in range(count):
+        label = 'good' if n < round(count * good_share) else bad[n % len(bad)]
+        img = VARIANTS[label](_leaf(rng, width, height), cv2)
+        ok, encoded = cv2.imencode('.jpg', img, [cv2.IMWRITE_JPEG_QUALITY, 90])
+        samples.append((label, encoded.tobytes()))
+    return samples
+
+
+class Command(BaseCommand):
+    help = 'Measure the cost of the image quality gate and the detection work it saves on a mixed-quality set'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--dir', help='Benchmark the images in this directory instead of a synthetic set')
+        parser.add_argument('--count', type=int, default=60, help='Synthetic images')
+        parser.add_argument('--good-share', type=float, default=0.5, help='Fraction of synthetic images that are usable')
+        parser.add_argument('--size', default='1920x1080', help='Synthetic image size, WIDTHxHEIGHT')
+        parser.add_argument('--seed', type=int, default=0)
+        parser.add_argument('--detect', action='store_true', help='Time real detection calls (needs DETECTION_API_URLS)')
+        parser.add_argument(
+            '--inference-ms', type=float, default=1000,
+            help='Assumed detector round trip plus annotation per image when --detect is not given'
+        )
+
+    def handle(self, *args, **options):
+        from whitefly.quality import assess_image
+
+        if options['dir']:
+            samples = []
+            for name in sorted(os.listdir(options['dir'])):
+                if name.lower().endswith(IMAGE_EXTENSIONS):
+                    with open(os.path.join(options['dir'], name), 'rb') as f:
+                        samples.append((name, f.read()))
+            if not samples:
+                raise CommandError(f"No images found in {options['dir']}")
+        else:
+            width, _, height = options['size'].partition('x')
+            self.stdout.write(f"Generating {options['count']} synthetic {options['size']} images...")
+            samples = _synthetic_set(
+                options['count'], options['good_share'], int(width), int(height), options['seed']
+            )
+
+        # Warm up the OpenCV/PIL imports so the first image is not charged for them
+        assess_image(samples[0][1])
+        decode_image(samples[0][1])
+
+        gate_ms = []
+        decode_ms = []
+        detect_ms = []
+        rejected = []
+        by_label = {}
+        for label, data in samples:
+            start = time.perf_counter()
+            quality = assess_image(data)
+            gate_ms.append((time.perf_counter() - start) * 1000)
+
+            # Reference: the full-resolution decode every passing image pays for annotation
+            start = time.perf_counter()
+            decode_image(data)
+            decode_ms.append((time.perf_counter() - start) * 1000)
+
+            if options['detect']:
+                start = time.perf_counter()
+                post_image([("files", (f'benchmark_{len(detect_ms)}.jpg', data))])
+                detect_ms.append((time.perf_counter() - start) * 1000)
+
+            if quality['issues']:
+                rejected.append(len(gate_ms) - 1)
+            if not options['dir']:
+                counts = by_label.setdefault(label, [0, 0])
+                counts[1 if quality['issues'] else 0] += 1
+
+        n = len(samples)
+        gate_total = sum(gate_ms)
+        if options['detect']:
+            saved = sum(detect_ms[i] for i in rejected)
+            basis = 'measured detection calls'
+        else:
+            saved = len(rejected) * options['inference_ms']
+            basis = f"assumed {options['inference_ms']:.0f} ms per detection (use --detect to measure)"
+        gate_ms.sort()
+
+        self.stdout.write(self.style.SUCCESS(
+            f'Quality gate on {n} image(s) (copy of {settings.QUALITY_CHECK_SIZE}px long side)'
+        ))
+        self.stdout.write(f'  gate median            {statistics.median(gate_ms):8.2f} ms')
+        self.stdout.write(f'  gate p95               {gate_ms[min(n - 1, int(n * 0.95))]:8.2f} ms')
+        self.stdout.write(f'  full decode median     {statistics.median(decode_ms):8.2f} ms (reference)')
+        if detect_ms:
+            self.stdout.write(f'  detection median       {statistics.median(detect_ms):8.2f} ms')
+        if by_label:
+            self.stdout.write('  passed/flagged by kind')
+            for label, (passed, flagged) in by_label.items():
+                self.stdout.write(f'    {label:<20} {passed:>4} / {flagged:<4}')
+        self.stdout.write(f'  rejected               {len(rejected):>5} of {n} ({len(rejected) / n:.0%})')
+        self.stdout.write(f'  detection time saved   {saved / 1000:8.1f} s ({basis})')
+        self.stdout.write(f'  gate time spent        {gate_total / 1000:8.1f} s')
+        self.stdout.write(f'  net saving             {(saved - gate_total) / 1000:8.1f} s')
@@ -0,0 +1,78 @@
+import json
+import os
+import statistics
+import subprocess
+import sys
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+
+# Runs in a fresh interpreter so module import costs are measured from cold
+PROBE = r'''
+import json, os, sys, time
+t0 = time.perf_counter()
+import django
+django.setup()
+import Whitefly_web.urls
+t1 = time.perf_counter()
+heavy_loaded = [m for m in ('cv2', 'numpy', 'PIL') if m in sys.modules]
+
+from django.test import Client
+response = Client(HTTP_HOST='localhost').get('/api/csrf/')
+t2 = time.perf_counter()
+
+from whitefly.utilities import decode_image
+with open(sys.argv[1], 'rb') as f:
+    data = f.read()
+decode_image(data)
+t3 = time.perf_counter()
+
+print(json.dumps({
+    'startup_ms': (t1 - t0) * 1000,
+    'first_request_ms': (t2 - t1) * 1000,
+    'first_image_ms': (t3 - t2) * 1000,
+    'heavy_loaded_at_startup': heavy_loaded,
+    'status': response.status_code,
+}))
+'''
+
+
+class Command(BaseCommand):
+    help = 'Measure worker startup, first API request and first image decode with lazy vs preloaded image stack'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--runs', type=int, default=5, help='Fresh processes per mode')
+
+    def handle(self, *args, **options):
+        import cv2
+        import numpy as np
+
+        # Small JPEG for the first-image step (OpenCV is already loaded in this process)
+        sample_path = os.path.join(settings.BASE_DIR, '.benchmark_startup.jpg')
+        ok, encoded = cv2.imencode('.jpg', np.full((480, 640, 3), 127, dtype=np.uint8))
+        with open(sample_path, 'wb') as f:
+            f.write(encoded.tobytes())
+
+        try:
+            for mode, preload in (('lazy (default)', 'False'), ('preloaded (eager)', 'True')):
+                env = dict(
+                    os.environ,
+                    DJANGO_SETTINGS_MODULE=os.environ.get('DJANGO_SETTINGS_MODULE', 'Whitefly_web.settings'),
+                    PRELOAD_IMAGE_STACK=preload,
+                )
+                runs = []
+                for _ in range(options['runs']):
+                    out = subprocess.run(
+                        [sys.executable, '-c', PROBE, sample_path],
+                        cwd=settings.BASE_DIR, env=env, capture_output=True, text=True, check=True,
+                    )
+                    runs.append(json.loads(out.stdout.strip().splitlines()[-1]))
+
+                self.stdout.write(self.style.SUCCESS(mode))
+                for key in ('startup_ms', 'first_request_ms', 'first_image_ms'):
+                    median = statistics.median(r[key] for r in runs)
+                    self.stdout.write(f'  {key:<18} {median:8.1f}')
+                self.stdout.write(f"  loaded at startup  {', '.join(runs[0]['heavy_loaded_at_startup']) or '-'}")
+        finally:
+            os.remove(sample_path)
@@ -0,0 +1,28 @@
+from django.db import migrations
+
+
+def create_gin_index(apps, schema_editor):
+    # JSONB GIN indexes only exist on PostgreSQL; SQLite stores JSON as text
+    if schema_editor.connection.vendor != 'postgresql':
+        return
+    schema_editor.execute(
+        'CREATE INDEX IF NOT EXISTS whitefly_result_coords_gin '
+        'ON whitefly_result USING GIN (annotated_coordinates jsonb_path_ops);'
+    )
+
+
+def drop_gin_index(apps, schema_editor):
+    if schema_editor.connection.vendor != 'postgresql':
+        return
+    schema_editor.execute('DROP INDEX IF EXISTS whitefly_result_coords_gin;')
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('whitefly', '0002_image_last_modified_image_upload_date_image_user_and_more'),
+    ]
+
+    operations = [
+        migrations.RunPython(create_gin_index, drop_gin_index),
+    ]
@@ -0,0 +1,45 @@
+# Generated by Django 4.2.25 on 2026-10-19 11:04
+
+from django.db import migrations, models
+
+
+def backfill_whitefly_count(apps, schema_editor):
+    Result = apps.get_model('whitefly', 'Result')
+    batch = []
+    for result in Result.objects.only('id', 'annotated_coordinates').iterator(chunk_size=1000):
+        result.whitefly_count = len(result.annotated_coordinates or [])
+        batch.append(result)
+        if len(batch) >= 1000:
+            Result.objects.bulk_update(batch, ['whitefly_count'])
+            batch = []
+    if batch:
+        Result.objects.bulk_update(batch, ['whitefly_count'])
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('whitefly', '0005_uploadsession'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='result',
+            name='whitefly_count',
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.RunPython(backfill_whitefly_count, migrations.RunPython.noop),
+        migrations.AlterField(
+            model_name='image',
+            name='upload_date',
+            field=models.DateTimeField(auto_now_add=True, db_index=True, null=True),
+        ),
+        migrations.AlterField(
+            model_name='result',
+            name='upload_date',
+            field=models.DateTimeField(auto_now_add=True, db_index=True, null=True),
+        ),
+        migrations.AddIndex(
+            model_name='image',
+            index=models.Index(fields=['user', '-upload_date'], name='whitefly_image_user_date'),
+        ),
+    ]
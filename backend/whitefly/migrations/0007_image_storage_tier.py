@@ -0,0 +1,18 @@
+# Generated by Django 4.2.25 on 2026-10-19 11:06
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('whitefly', '0006_result_whitefly_count_and_date_indexes'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='image',
+            name='storage_tier',
+            field=models.CharField(choices=[('hot', 'Original'), ('compressed', 'Recompressed'), ('cold', 'Cold storage')], default='hot', max_length=16),
+        ),
+    ]
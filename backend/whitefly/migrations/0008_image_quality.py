@@ -0,0 +1,28 @@
+# Generated by Django 4.2.25 on 2026-10-19 11:10
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('whitefly', '0007_image_storage_tier'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='image',
+            name='quality_issues',
+            field=models.CharField(blank=True, max_length=128),
+        ),
+        migrations.AddField(
+            model_name='image',
+            name='quality_score',
+            field=models.FloatField(blank=True, null=True),
+        ),
+        migrations.AlterField(
+            model_name='uploadsession',
+            name='status',
+            field=models.CharField(choices=[('uploading', 'Uploading'), ('processing', 'Processing'), ('complete', 'Complete'), ('rejected', 'Rejected by quality check')], default='uploading', max_length=16),
+        ),
+    ]
@@ -1,16 +1,78 @@
+import os
+import uuid
+
+from django.conf import settings
 from django.db import models
 from django.contrib.auth.models import User
 
 # Create your models here.
 class Image(models.Model): 
+    TIER_HOT = 'hot'
+    TIER_COMPRESSED = 'compressed'
+    TIER_COLD = 'cold'
+    TIER_CHOICES = [
+        (TIER_HOT, 'Original'),
+        (TIER_COMPRESSED, 'Recompressed'),
+        (TIER_COLD, 'Cold storage'),
+    ]
+
     user = models.ForeignKey(User, on_delete=models.CASCADE, default=1)
     name = models.CharField(max_length=524, blank=True)
     images = models.FileField(upload_to='whitefly_uploads/')
-    upload_date = models.DateTimeField(auto_now_add=True, null=True) 
+    width = models.PositiveIntegerField(null=True, blank=True)  # Pixel size, used to normalize detections
+    height = models.PositiveIntegerField(null=True, blank=True)
+    storage_tier = models.CharField(max_length=16, choices=TIER_CHOICES, default=TIER_HOT)  # Set by apply_retention
+    quality_score = models.FloatField(null=True, blank=True)  # 1.0 passed every quality check, null if not checked
+    quality_issues = models.CharField(max_length=128, blank=True)  # Comma-separated failed checks
+    upload_date = models.DateTimeField(auto_now_add=True, null=True, db_index=True) 
     last_modified = models.DateTimeField(auto_now=True, null=True) 
 
+    class Meta:
+        indexes = [
+            models.Index(fields=['user', '-upload_date'], name='whitefly_image_user_date'),
+        ]
+
+    def original_path(self):
+        """Filesystem path of the original, wherever retention has put it"""
+        if self.storage_tier == self.TIER_COLD:
+            return os.path.join(settings.RETENTION_COLD_DIR, self.images.name)
+        return self.images.path
+
 class Result(models.Model):
     image = models.ForeignKey(Image, on_delete=models.CASCADE) 
     annotated_coordinates = models.JSONField()  # Store annotated coordinates as a JSON field  
-    upload_date = models.DateTimeField(auto_now_add=True, null=True) 
-    last_modified = models.DateTimeField(auto_now=True, null=True) 
\ No newline at end of file
+    whitefly_count = models.PositiveIntegerField(default=0)  # len(annotated_coordinates), kept in sync by save()
+    upload_date = models.DateTimeField(auto_now_add=True, null=True, db_index=True) 
+    last_modified = models.DateTimeField(auto_now=True, null=True)
+
+    def save(self, *args, **kwargs):
+        self.whitefly_count = len(self.annotated_coordinates or [])
+        update_fields = kwargs.get('update_fields')
+        if update_fields is not None and 'annotated_coordinates' in update_fields:
+            kwargs['update_fields'] = set(update_fields) | {'whitefly_count'}
+        super().save(*args, **kwargs)
+
+
+class UploadSession(models.Model):
+    """A resumable chunked upload of one image (see /api/uploads/)"""
+    STATUS_UPLOADING = 'uploading'
+    STATUS_PROCESSING = 'processing'
+    STATUS_COMPLETE = 'complete'
+    STATUS_REJECTED = 'rejected'
+    STATUS_CHOICES = [
+        (STATUS_UPLOADING, 'Uploading'),
+        (STATUS_PROCESSING, 'Processing'),
+        (STATUS_COMPLETE, 'Complete'),
+        (STATUS_REJECTED, 'Rejected by quality check'),
+    ]
+
+    id = models.UUIDField(primary_key=True, default=uuid.uuid4, editable=False)
+    user = models.ForeignKey(User, on_delete=models.CASCADE)
+    filename = models.CharField(max_length=524)
+    size = models.PositiveBigIntegerField()  # Total bytes expected
+    offset = models.PositiveBigIntegerField(default=0)  # Bytes received and verified so far
+    sha256 = models.CharField(max_length=64, blank=True)  # Optional whole-file checksum
+    status = models.CharField(max_length=16, choices=STATUS_CHOICES, default=STATUS_UPLOADING)
+    result = models.ForeignKey(Result, null=True, blank=True, on_delete=models.SET_NULL)
+    upload_date = models.DateTimeField(auto_now_add=True, null=True)
+    last_modified = models.DateTimeField(auto_now=True, null=True)
@@ -0,0 +1,203 @@
+"""Opt-in request profiling.
+
+With ``PROFILING_ENABLED`` every request records its SQL queries and the
+stage timers below (cheap: a few perf_counter calls). A fraction of requests
+(``PROFILING_SAMPLE_RATE``), or any staff request sending the
+``PROFILING_HEADER`` header, also runs under cProfile. Requests slower than
+``PROFILING_SLOW_MS`` and all header-triggered ones are written as JSON to
+``PROFILING_DIR``, which keeps the newest ``PROFILING_MAX_ENTRIES`` files and
+is browsable at /admin/profiles/.
+"""
+import contextvars
+import cProfile
+import io
+import json
+import os
+import pstats
+import random
+import re
+import time
+import uuid
+from contextlib import ExitStack, contextmanager
+
+from django.conf import settings
+from django.contrib import admin
+from django.core.exceptions import MiddlewareNotUsed
+from django.db import connections
+from django.http import Http404
+from django.template.response import TemplateResponse
+
+
+SLOWEST_QUERIES = 10
+PROFILE_LINES = 40
+PROFILE_ID = re.compile(r'^[0-9]+-[0-9a-f]{8}$')
+
+_current = contextvars.ContextVar('whitefly_profile', default=None)
+
+
+@contextmanager
+def stage(name):
+    """Time a block of the current request; free when profiling is off"""
+    record = _current.get()
+    if record is None:
+        yield
+        return
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        stages = record['stages']
+        stages[name] = stages.get(name, 0) + (time.perf_counter() - start) * 1000
+
+
+def _sql_wrapper(record):
+    def wrapper(execute, sql, params, many, context):
+        start = time.perf_counter()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            # Includes time spent waiting on SQLite's write lock
+            elapsed = (time.perf_counter() - start) * 1000
+            record['sql_count'] += 1
+            record['sql_ms'] += elapsed
+            queries = record['queries']
+            queries.append((elapsed, sql[:500]))
+            if len(queries) > SLOWEST_QUERIES * 4:
+                queries.sort(reverse=True)
+                del queries[SLOWEST_QUERIES:]
+    return wrapper
+
+
+class ProfilingMiddleware:
+    def __init__(self, get_response):
+        if not settings.PROFILING_ENABLED:
+            raise MiddlewareNotUsed
+        self.get_response = get_response
+        self.header = settings.PROFILING_HEADER
+
+    def __call__(self, request):
+        user = getattr(request, 'user', None)
+        forced = bool(request.headers.get(self.header)) and user is not None and user.is_staff
+        sampled = forced or random.random() < settings.PROFILING_SAMPLE_RATE
+
+        record = {'stages': {}, 'sql_count': 0, 'sql_ms': 0.0, 'queries': []}
+        token = _current.set(record)
+        profiler = cProfile.Profile() if sampled else None
+        start = time.perf_counter()
+        try:
+            with ExitStack() as stack:
+                for alias in settings.DATABASES:
+                    stack.enter_context(connections[alias].execute_wrapper(_sql_wrapper(record)))
+                if profiler is not None:
+                    profiler.enable()
+                try:
+                    response = self.get_response(request)
+                finally:
+                    if profiler is not None:
+                        profiler.disable()
+        finally:
+            _current.reset(token)
+        elapsed = (time.perf_counter() - start) * 1000
+
+        if forced or elapsed >= settings.PROFILING_SLOW_MS:
+            try:
+                profile_id = save_profile(request, response, elapsed, record, profiler, forced)
+            except OSError as e:
+                print(f"Could not save request profile: {e}")
+            else:
+                if forced:
+                    response['X-Profile-Id'] = profile_id
+        return response
+
+
+def _profile_text(profiler):
+    out = io.StringIO()
+    pstats.Stats(profiler, stream=out).sort_stats('cumulative').print_stats(PROFILE_LINES)
+    return out.getvalue()
+
+
+def save_profile(request, response, elapsed, record, profiler=None, forced=False):
+    """Write one request to the ring buffer, dropping the oldest entries; returns its id"""
+    profile_dir = settings.PROFILING_DIR
+    os.makedirs(profile_dir, exist_ok=True)
+    profile_id = f'{int(time.time() * 1000)}-{uuid.uuid4().hex[:8]}'
+    user = getattr(request, 'user', None)
+    queries = sorted(record['queries'], reverse=True)[:SLOWEST_QUERIES]
+    entry = {
+        'id': profile_id,
+        'time': time.time(),
+        'method': request.method,
+        'path': request.get_full_path(),
+        'user': user.get_username() if user is not None and user.is_authenticated else None,
+        'status': response.status_code,
+        'streaming': response.streaming,  # Body generated after the timers stopped
+        'trigger': 'header' if forced else ('sampled' if profiler is not None else 'slow'),
+        'duration_ms': round(elapsed, 2),
+        'sql_count': record['sql_count'],
+        'sql_ms': round(record['sql_ms'], 2),
+        'stages': {name: round(ms, 2) for name, ms in record['stages'].items()},
+        'slowest_queries': [{'ms': round(ms, 2), 'sql': sql} for ms, sql in queries],
+        'profile': _profile_text(profiler) if profiler is not None else None,
+    }
+
+    path = os.path.join(profile_dir, profile_id + '.json')
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'w') as f:
+        json.dump(entry, f)
+    os.replace(tmp_path, path)
+
+    # Ids start with a millisecond timestamp, so name order is age order
+    names = sorted(n for n in os.listdir(profile_dir) if n.endswith('.json'))
+    for name in names[:-max(1, settings.PROFILING_MAX_ENTRIES)]:
+        try:
+            os.remove(os.path.join(profile_dir, name))
+        except OSError:
+            pass
+    return profile_id
+
+
+def load_profile(profile_id):
+    if not PROFILE_ID.match(profile_id):
+        return None
+    try:
+        with open(os.path.join(settings.PROFILING_DIR, profile_id + '.json')) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+def list_profiles():
+    """Saved entries, newest first"""
+    try:
+        names = sorted((n[:-5] for n in os.listdir(settings.PROFILING_DIR) if n.endswith('.json')), reverse=True)
+    except OSError:
+        return []
+    entries = (load_profile(name) for name in names)
+    return [e for e in entries if e is not None]
+
+
+# Admin pages, wrapped with admin.site.admin_view in Whitefly_web/urls.py
+
+def profile_list_view(request):
+    context = dict(
+        admin.site.each_context(request),
+        title='Request profiles',
+        profiles=list_profiles(),
+        profiling_enabled=settings.PROFILING_ENABLED,
+        slow_ms=settings.PROFILING_SLOW_MS,
+        max_entries=settings.PROFILING_MAX_ENTRIES,
+    )
+    return TemplateResponse(request, 'admin/whitefly/profiles/list.html', context)
+
+
+def profile_detail_view(request, profile_id):
+    entry = load_profile(profile_id)
+    if entry is None:
+        raise Http404('Profile not found')
+    context = dict(
+        admin.site.each_context(request),
+        title=f"{entry['method']} {entry['path']}",
+        entry=entry,
+        stages=sorted(entry['stages'].items(), key=lambda s: -s[1]),
+    )
+    return TemplateResponse(request, 'admin/whitefly/profiles/detail.html', context)
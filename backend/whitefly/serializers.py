@@ -30,21 +30,22 @@ class ImageSerializer(serializers.ModelSerializer):
 
     class Meta:
         model = Image
-        fields = ['id', 'name', 'images', 'user', 'upload_date', 'last_modified']
-        read_only_fields = ['user', 'upload_date', 'last_modified']
+        fields = [
+            'id', 'name', 'images', 'width', 'height', 'quality_score', 'quality_issues',
+            'user', 'upload_date', 'last_modified'
+        ]
+        read_only_fields = [
+            'user', 'width', 'height', 'quality_score', 'quality_issues', 'upload_date', 'last_modified'
+        ]
 
 
 class ResultSerializer(serializers.ModelSerializer):
     image = ImageSerializer(read_only=True)
-    whitefly_count = serializers.SerializerMethodField()
 
     class Meta:
         model = Result
         fields = ['id', 'image', 'annotated_coordinates', 'whitefly_count', 'upload_date', 'last_modified']
-        read_only_fields = ['upload_date', 'last_modified']
-
-    def get_whitefly_count(self, obj):
-        return len(obj.annotated_coordinates) if obj.annotated_coordinates else 0
+        read_only_fields = ['whitefly_count', 'upload_date', 'last_modified']
 
 
 class UploadResponseSerializer(serializers.Serializer):
@@ -52,5 +53,7 @@ class UploadResponseSerializer(serializers.Serializer):
     result_id = serializers.IntegerField()
     image_name = serializers.CharField()
     whitefly_count = serializers.IntegerField()
+    quality_score = serializers.FloatField(allow_null=True)
+    quality_issues = serializers.ListField(child=serializers.CharField())
     annotated_image_url = serializers.CharField()
     original_image_url = serializers.CharField()
@@ -0,0 +1,42 @@
+from django.db import transaction
+from django.db.backends.signals import connection_created
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import receiver
+
+from .cache import invalidate_user_cache
+from .models import Image, Result
+
+
+@receiver(connection_created)
+def configure_sqlite(sender, connection, **kwargs):
+    """Tune every new SQLite connection for concurrent gunicorn workers"""
+    if connection.vendor != 'sqlite':
+        return
+
+    with connection.cursor() as cursor:
+        # WAL lets readers keep going while an upload holds the write lock
+        cursor.execute('PRAGMA journal_mode=WAL;')
+        # Safe with WAL and avoids an fsync on every commit
+        cursor.execute('PRAGMA synchronous=NORMAL;')
+        cursor.execute('PRAGMA foreign_keys=ON;')
+
+
+def _invalidate_on_commit(user_id):
+    # Invalidating before commit would let a concurrent read re-cache old rows
+    transaction.on_commit(lambda: invalidate_user_cache(user_id))
+
+
+@receiver(post_save, sender=Image)
+@receiver(post_delete, sender=Image)
+def invalidate_image_cache(sender, instance, **kwargs):
+    _invalidate_on_commit(instance.user_id)
+
+
+@receiver(post_save, sender=Result)
+@receiver(post_delete, sender=Result)
+def invalidate_result_cache(sender, instance, **kwargs):
+    try:
+        user_id = instance.image.user_id
+    except Image.DoesNotExist:
+        return
+    _invalidate_on_commit(user_id)
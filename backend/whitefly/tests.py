@@ -0,0 +1,597 @@
+import hashlib
+import io
+import os
+import shutil
+import tempfile
+from datetime import timedelta
+from unittest import mock
+
+from django.contrib.auth.models import User
+from django.test import TestCase, override_settings
+from django.utils import timezone
+from PIL import Image as PILImage
+from rest_framework.test import APIClient
+
+from whitefly import admission
+from whitefly.models import Image, Result, UploadSession
+
+
+def _jpeg(width=64, height=48):
+    out = io.BytesIO()
+    PILImage.new('RGB', (width, height), (30, 140, 60)).save(out, 'JPEG')
+    return out.getvalue()
+
+
+def _fake_detection(files, *args, **kwargs):
+    return [{'result': [{'0': {'xmin': 1, 'ymin': 2, 'xmax': 10, 'ymax': 12}}]}]
+
+
+class ChunkedUploadTests(TestCase):
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmp, ignore_errors=True)
+        overrides = override_settings(
+            CHUNKED_UPLOAD_DIR=os.path.join(self.tmp, 'chunks'),
+            MEDIA_ROOT=os.path.join(self.tmp, 'media'),
+            UPLOAD_ADMISSION_STORE=os.path.join(self.tmp, 'admission.sqlite3'),
+            QUALITY_GATE='off',
+        )
+        overrides.enable()
+        self.addCleanup(overrides.disable)
+        # The admission controller is a per-process singleton built from settings
+        admission._controller = None
+        self.addCleanup(setattr, admission, '_controller', None)
+
+        self.user = User.objects.create_user('grower', password='x')
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+        self.data = _jpeg()
+
+    def _start(self, **extra):
+        response = self.client.post(
+            '/api/uploads/', {'filename': 'leaf.jpg', 'size': len(self.data), **extra}, format='json'
+        )
+        self.assertEqual(response.status_code, 201)
+        return response.data['upload_id']
+
+    def _put(self, upload_id, offset, chunk, sha256=None):
+        return self.client.generic(
+            'PUT', f'/api/uploads/{upload_id}/chunk/', chunk,
+            content_type='application/octet-stream',
+            HTTP_UPLOAD_OFFSET=str(offset),
+            HTTP_X_CHUNK_SHA256=sha256 or hashlib.sha256(chunk).hexdigest(),
+        )
+
+    def _part(self, upload_id):
+        with open(os.path.join(self.tmp, 'chunks', f'{upload_id}.part'), 'rb') as f:
+            return f.read()
+
+    def _complete(self, upload_id):
+        with mock.patch('whitefly.api_views.post_image', side_effect=_fake_detection), \
+                mock.patch('whitefly.api_views.render_annotated_image'), \
+                mock.patch('whitefly.api_views.save_results'):
+            return self.client.post(f'/api/uploads/{upload_id}/complete/')
+
+    def test_resume_after_dropped_chunk(self):
+        upload_id = self._start(sha256=hashlib.sha256(self.data).hexdigest())
+        half = len(self.data) // 2
+
+        self.assertEqual(self._put(upload_id, 0, self.data[:half]).status_code, 200)
+        # The connection drops: the client asks where to resume and sends the rest
+        response = self.client.get(f'/api/uploads/{upload_id}/')
+        self.assertEqual(response.data['offset'], half)
+        # A stale retry of the first chunk is refused without touching the file
+        self.assertEqual(self._put(upload_id, 0, self.data[:half]).status_code, 409)
+        self.assertEqual(self._put(upload_id, half, self.data[half:]).status_code, 200)
+        self.assertEqual(self._part(upload_id), self.data)
+
+        response = self._complete(upload_id)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.data['status'], UploadSession.STATUS_COMPLETE)
+        self.assertEqual(response.data['result']['whitefly_count'], 1)
+        self.assertEqual(Image.objects.get().width, 64)
+
+        # Repeating complete returns the same result instead of detecting again
+        repeat = self._complete(upload_id)
+        self.assertEqual(repeat.data['result']['result_id'], response.data['result']['result_id'])
+
+    def test_bad_chunk_checksum_leaves_upload_unchanged(self):
+        upload_id = self._start()
+        half = len(self.data) // 2
+        self.assertEqual(self._put(upload_id, 0, self.data[:half]).status_code, 200)
+
+        response = self._put(upload_id, half, self.data[half:], sha256='0' * 64)
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(response.data['offset'], half)
+        self.assertEqual(UploadSession.objects.get().offset, half)
+        self.assertEqual(self._part(upload_id), self.data[:half])
+        # No received-but-unverified chunk files are left behind
+        self.assertEqual(os.listdir(os.path.join(self.tmp, 'chunks')), [f'{upload_id}.part'])
+
+    def test_whole_file_checksum_mismatch_restarts_upload(self):
+        upload_id = self._start(sha256='f' * 64)
+        self.assertEqual(self._put(upload_id, 0, self.data).status_code, 200)
+
+        response = self._complete(upload_id)
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(response.data['offset'], 0)
+        self.assertEqual(self._part(upload_id), b'')
+        self.assertFalse(Image.objects.exists())
+
+    def test_stuck_processing_session_is_reopened(self):
+        upload_id = self._start()
+        self.assertEqual(self._put(upload_id, 0, self.data).status_code, 200)
+        # A worker claimed the session and died before finishing
+        UploadSession.objects.filter(pk=upload_id).update(
+            status=UploadSession.STATUS_PROCESSING, last_modified=timezone.now() - timedelta(hours=1)
+        )
+
+        response = self._complete(upload_id)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.data['status'], UploadSession.STATUS_COMPLETE)
+
+    def test_expired_sessions_are_swept_on_create(self):
+        abandoned = self._start()
+        self.assertEqual(self._put(abandoned, 0, self.data[:10]).status_code, 200)
+        old = timezone.now() - timedelta(hours=49)
+        UploadSession.objects.filter(pk=abandoned).update(last_modified=old)
+        part = os.path.join(self.tmp, 'chunks', f'{abandoned}.part')
+        os.utime(part, (old.timestamp(), old.timestamp()))
+        # A chunk file left by a killed worker, with no session at all
+        stray = os.path.join(self.tmp, 'chunks', 'not-a-session.part')
+        open(stray, 'wb').close()
+        os.utime(stray, (old.timestamp(), old.timestamp()))
+
+        fresh = self._start()
+        self.assertFalse(UploadSession.objects.filter(pk=abandoned).exists())
+        self.assertEqual(os.listdir(os.path.join(self.tmp, 'chunks')), [f'{fresh}.part'])
+
+    @override_settings(CHUNKED_UPLOAD_MAX_OPEN_PER_USER=2)
+    def test_open_sessions_are_capped_per_user(self):
+        first = self._start()
+        self._start()
+        response = self.client.post('/api/uploads/', {'filename': 'leaf.jpg', 'size': len(self.data)}, format='json')
+        self.assertEqual(response.status_code, 429)
+
+        # Finishing one frees a slot
+        self.assertEqual(self._put(first, 0, self.data).status_code, 200)
+        self.assertEqual(self._complete(first).status_code, 200)
+        self._start()
+
+
+class RetentionTests(TestCase):
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmp, ignore_errors=True)
+        overrides = override_settings(
+            MEDIA_ROOT=os.path.join(self.tmp, 'media'),
+            RETENTION_COLD_DIR=os.path.join(self.tmp, 'cold'),
+        )
+        overrides.enable()
+        self.addCleanup(overrides.disable)
+        results_dir = mock.patch('whitefly.utilities.results_dir', os.path.join(self.tmp, 'results'))
+        results_dir.start()
+        self.addCleanup(results_dir.stop)
+
+        from django.core.files.base import ContentFile
+        from whitefly.models import Result
+        from whitefly.utilities import annotated_image_path, render_annotated_image
+
+        self.user = User.objects.create_user('grower', password='x')
+        self.image = Image.objects.create(
+            user=self.user, name='leaf.png', images=ContentFile(_jpeg(), name='leaf.png'), width=64, height=48
+        )
+        result = Result.objects.create(image=self.image, annotated_coordinates=_fake_detection(None)[0]['result'])
+        render_annotated_image(self.image.images.url, _jpeg(), result.annotated_coordinates)
+        self.annotated = annotated_image_path(self.image.images.url)
+        old = timezone.now() - timedelta(days=400)
+        Image.objects.update(upload_date=old)
+        Result.objects.update(upload_date=old)
+
+    def _retention(self, action):
+        from django.core.management import call_command
+        call_command('apply_retention', originals_action=action, stdout=io.StringIO())
+        self.image.refresh_from_db()
+
+    @override_settings(DEBUG=True)
+    def test_annotated_image_is_redrawn_on_access(self):
+        self._retention('none')
+        self.assertFalse(os.path.exists(self.annotated))
+        url = f'/media/whitefly_results/{os.path.basename(self.annotated)}'
+
+        # Only the owner may trigger the redraw
+        self.assertEqual(self.client.get(url).status_code, 404)
+        User.objects.create_user('neighbour', password='x')
+        self.client.login(username='neighbour', password='x')
+        self.assertEqual(self.client.get(url).status_code, 404)
+        self.assertFalse(os.path.exists(self.annotated))
+
+        self.client.force_login(self.user)
+        response = self.client.get(url)
+        self.assertEqual(response.status_code, 200)
+        response.close()
+        self.assertTrue(os.path.exists(self.annotated))
+
+    @override_settings(DEBUG=True)
+    def test_cold_original_keeps_its_url(self):
+        hot_path = self.image.images.path
+        url = self.image.images.url
+        self._retention('move')
+
+        self.assertEqual(self.image.storage_tier, Image.TIER_COLD)
+        self.assertFalse(os.path.exists(hot_path))
+        self.assertTrue(os.path.exists(self.image.original_path()))
+        self.client.force_login(self.user)
+        response = self.client.get(url)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(b''.join(response.streaming_content)[:2], b'\xff\xd8')
+
+    @override_settings(MEDIA_ACCEL_REDIRECT='/protected/')
+    def test_production_media_is_sent_by_nginx(self):
+        url = self.image.images.url
+        self.assertEqual(self.client.get(url).status_code, 404)
+
+        self.client.force_login(self.user)
+        response = self.client.get(url)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response['X-Accel-Redirect'], f'/protected/media/{self.image.images.name}')
+        self.assertEqual(response.content, b'')
+
+    @override_settings(DEBUG=True)
+    def test_recompressed_original_keeps_its_name_and_links(self):
+        # A noisy PNG, which JPEG always shrinks
+        noise = PILImage.frombytes('RGB', (64, 48), os.urandom(64 * 48 * 3))
+        noise.save(self.image.images.path, 'PNG')
+        name, url = self.image.images.name, self.image.images.url
+        self._retention('recompress')
+
+        self.assertEqual(self.image.storage_tier, Image.TIER_COMPRESSED)
+        self.assertEqual(self.image.images.name, name)
+        with open(self.image.images.path, 'rb') as f:
+            self.assertEqual(f.read(2), b'\xff\xd8')
+        self.assertEqual(os.listdir(os.path.dirname(self.image.images.path)), ['leaf.png'])
+
+        self.client.force_login(self.user)
+        response = self.client.get(url)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response['Content-Type'], 'image/jpeg')
+        response.close()
+        response = self.client.get(f'/media/whitefly_results/{os.path.basename(self.annotated)}')
+        self.assertEqual(response.status_code, 200)
+        response.close()
+
+    def test_export_redraws_missing_annotated_images(self):
+        import zipfile
+        from whitefly.export import iter_export_zip
+        from whitefly.models import Result
+
+        self._retention('none')
+        archive = b''.join(iter_export_zip(Result.objects.select_related('image')))
+        names = zipfile.ZipFile(io.BytesIO(archive)).namelist()
+        self.assertIn(f'annotated/{self.image.id}_{os.path.basename(self.annotated)}', names)
+
+
+class BatchUploadTests(TestCase):
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmp, ignore_errors=True)
+        overrides = override_settings(
+            MEDIA_ROOT=os.path.join(self.tmp, 'media'),
+            UPLOAD_ADMISSION_STORE=os.path.join(self.tmp, 'admission.sqlite3'),
+            QUALITY_GATE='off',
+        )
+        overrides.enable()
+        self.addCleanup(overrides.disable)
+        admission._controller = None
+        self.addCleanup(setattr, admission, '_controller', None)
+        for target in ('whitefly.api_views.render_annotated_image', 'whitefly.api_views.save_results'):
+            patcher = mock.patch(target)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+        self.user = User.objects.create_user('grower', password='x')
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+
+    def _upload(self, *files, **extra):
+        from django.core.files.uploadedfile import SimpleUploadedFile
+        return self.client.post('/api/upload/', {
+            'images': [SimpleUploadedFile(name, data, 'image/jpeg') for name, data in files]
+        }, format='multipart', **extra)
+
+    def test_unreadable_file_is_a_json_400_without_detection(self):
+        with mock.patch('whitefly.api_views.post_image', side_effect=_fake_detection) as post:
+            response = self._upload(('leaf.jpg', _jpeg()), ('notes.jpg', b'not an image'))
+        self.assertEqual(response.status_code, 400)
+        self.assertIn('notes.jpg', response.json()['error'])
+        post.assert_not_called()
+        self.assertFalse(Image.objects.exists())
+
+    @override_settings(QUALITY_GATE='flag')
+    def test_undecodable_image_is_rejected_even_when_flagging(self):
+        # A valid JPEG header with the pixel data cut off
+        data = _jpeg(640, 480)
+        truncated = data[:len(data) // 2]
+        with mock.patch('whitefly.api_views.post_image', side_effect=_fake_detection) as post:
+            response = self._upload(('cut.jpg', truncated))
+        self.assertEqual(response.status_code, 422)
+        self.assertEqual(response.json()['rejected'][0]['quality']['issues'], ['unreadable'])
+        post.assert_not_called()
+
+    def test_busy_server_keeps_finished_detections(self):
+        from whitefly.admission import AdmissionController, AdmissionRejected
+
+        acquire = mock.patch.object(AdmissionController, 'acquire', side_effect=[1, AdmissionRejected(7)])
+        with acquire, mock.patch('whitefly.api_views.post_image', side_effect=_fake_detection) as post:
+            response = self._upload(('a.jpg', _jpeg()), ('b.jpg', _jpeg()))
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(post.call_count, 1)
+        self.assertEqual([r['image_name'] for r in response.json()['results']], ['a.jpg'])
+        self.assertEqual([r['image_name'] for r in response.json()['not_processed']], ['b.jpg'])
+        self.assertEqual(response['Retry-After'], '7')
+        self.assertEqual(Image.objects.count(), 1)
+
+    def test_failed_save_removes_written_files(self):
+        save = mock.patch.object(Result, 'save', autospec=True, side_effect=[None, Exception('disk full')])
+        with save, mock.patch('whitefly.api_views.post_image', side_effect=_fake_detection):
+            response = self._upload(('a.jpg', _jpeg()), ('b.jpg', _jpeg()))
+        self.assertEqual(response.status_code, 500)
+        self.assertFalse(Image.objects.exists())
+        self.assertEqual(os.listdir(os.path.join(self.tmp, 'media', 'whitefly_uploads')), [])
+
+    def test_busy_server_ends_the_stream(self):
+        import json
+        from whitefly.admission import AdmissionController, AdmissionRejected
+
+        acquire = mock.patch.object(AdmissionController, 'acquire', side_effect=[1, AdmissionRejected(7)])
+        with acquire as slots, mock.patch('whitefly.api_views.post_image', side_effect=_fake_detection):
+            response = self._upload(
+                ('a.jpg', _jpeg()), ('b.jpg', _jpeg()), ('c.jpg', _jpeg()), QUERY_STRING='stream=ndjson'
+            )
+            events = [json.loads(line) for line in b''.join(response.streaming_content).splitlines()]
+        # c.jpg never waited for a slot
+        self.assertEqual(slots.call_count, 2)
+        self.assertEqual([e['type'] for e in events], ['result', 'not_processed', 'not_processed', 'done'])
+        self.assertEqual([e['retry_after'] for e in events[1:3]], [7, 7])
+        self.assertEqual(events[-1]['not_processed'], 2)
+        self.assertEqual(events[-1]['retry_after'], 7)
+
+    @override_settings(UPLOAD_MAX_BYTES_PER_REQUEST=1000)
+    def test_oversized_body_is_refused_before_parsing(self):
+        with mock.patch('rest_framework.request.Request._parse') as parse:
+            response = self._upload(('a.jpg', b'x' * 2000))
+        self.assertEqual(response.status_code, 413)
+        parse.assert_not_called()
+
+
+class AdminTests(TestCase):
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmp, ignore_errors=True)
+        overrides = override_settings(
+            MEDIA_ROOT=os.path.join(self.tmp, 'media'),
+            UPLOAD_ADMISSION_STORE=os.path.join(self.tmp, 'admission.sqlite3'),
+        )
+        overrides.enable()
+        self.addCleanup(overrides.disable)
+        admission._controller = None
+        self.addCleanup(setattr, admission, '_controller', None)
+
+        from django.core.files.base import ContentFile
+        from whitefly.models import Result
+
+        self.admin = User.objects.create_superuser('admin', password='x')
+        self.client.force_login(self.admin)
+        for n in range(3):
+            owner = User.objects.create_user(f'grower{n}', password='x')
+            image = Image.objects.create(user=owner, name=f'{n}.jpg', images=ContentFile(_jpeg(), name=f'{n}.jpg'))
+            Result.objects.create(image=image, annotated_coordinates=[])
+
+    def test_user_filter_is_a_text_box(self):
+        response = self.client.get('/admin/whitefly/result/', {'username': 'grower1'})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(len(response.context['cl'].result_list), 1)
+        self.assertContains(response, 'name="username"')
+        # Other users are not listed as filter links
+        self.assertNotContains(response, 'grower2')
+
+    def _rerun(self, results):
+        return self.client.post('/admin/whitefly/result/', {
+            'action': 'rerun_detection',
+            '_selected_action': [r.pk for r in results],
+        }, follow=True)
+
+    def test_rerun_detection_uses_admission_slots(self):
+        from whitefly.admission import AdmissionController
+        from whitefly.models import Result
+
+        with mock.patch.object(AdmissionController, 'acquire', return_value=1) as acquire, \
+                mock.patch('whitefly.api_views.post_image', side_effect=_fake_detection), \
+                mock.patch('whitefly.admin.render_annotated_image'):
+            self._rerun(Result.objects.all())
+        self.assertEqual(acquire.call_count, 3)
+        self.assertEqual(set(Result.objects.values_list('whitefly_count', flat=True)), {1})
+
+    @mock.patch('whitefly.admin.RERUN_DETECTION_LIMIT', 2)
+    def test_rerun_detection_refuses_large_selections(self):
+        from whitefly.models import Result
+
+        with mock.patch('whitefly.api_views.post_image', side_effect=_fake_detection) as post:
+            response = self._rerun(Result.objects.all())
+        post.assert_not_called()
+        self.assertContains(response, 'Select at most 2 results')
+
+
+class AnalysisTests(TestCase):
+    def setUp(self):
+        from django.core.files.base import ContentFile
+
+        self.tmp = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmp, ignore_errors=True)
+        overrides = override_settings(MEDIA_ROOT=os.path.join(self.tmp, 'media'))
+        overrides.enable()
+        self.addCleanup(overrides.disable)
+
+        self.user = User.objects.create_user('grower', password='x')
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+        # Legacy rows: no stored size, so it is read from the original
+        self.results = []
+        for name in ('kept.jpg', 'lost.jpg'):
+            image = Image.objects.create(user=self.user, name=name, images=ContentFile(_jpeg(), name=name))
+            self.results.append(
+                Result.objects.create(image=image, annotated_coordinates=_fake_detection(None)[0]['result'])
+            )
+        os.remove(self.results[1].image.images.path)
+
+    def test_density_skips_images_without_a_readable_original(self):
+        response = self.client.get('/api/analysis/density/')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json()['image_count'], 1)
+        self.assertEqual(response.json()['skipped_count'], 1)
+        self.assertEqual(response.json()['stats']['detections'], 1)
+
+    def test_heatmap_of_missing_original_is_a_json_409(self):
+        response = self.client.get(f'/api/results/{self.results[1].id}/heatmap/')
+        self.assertEqual(response.status_code, 409)
+        self.assertIn('lost.jpg', response.json()['error'])
+
+
+@override_settings(CACHES={'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}})
+class ApiCacheTests(TestCase):
+    def setUp(self):
+        from django.core.cache import cache
+        from django.core.files.base import ContentFile
+
+        cache.clear()
+        self.tmp = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmp, ignore_errors=True)
+        overrides = override_settings(MEDIA_ROOT=os.path.join(self.tmp, 'media'))
+        overrides.enable()
+        self.addCleanup(overrides.disable)
+
+        self.user = User.objects.create_user('grower', password='x')
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+        self.image = Image.objects.create(
+            user=self.user, name='leaf.jpg', images=ContentFile(_jpeg(), name='leaf.jpg'), width=64, height=48
+        )
+        Result.objects.create(image=self.image, annotated_coordinates=[])
+
+    def _add_result(self):
+        # Invalidation runs on commit, which TestCase otherwise never reaches
+        with self.captureOnCommitCallbacks(execute=True):
+            Result.objects.create(image=self.image, annotated_coordinates=_fake_detection(None)[0]['result'])
+
+    def test_saving_a_result_invalidates_the_cached_list(self):
+        self.assertEqual(len(self.client.get('/api/results/').json()), 1)
+        with self.assertNumQueries(0):
+            self.assertEqual(len(self.client.get('/api/results/').json()), 1)
+
+        self._add_result()
+        self.assertEqual(len(self.client.get('/api/results/').json()), 2)
+
+    def test_etag_answers_304_until_the_data_changes(self):
+        etag = self.client.get('/api/results/')['ETag']
+        response = self.client.get('/api/results/', HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 304)
+
+        self._add_result()
+        response = self.client.get('/api/results/', HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertNotEqual(response['ETag'], etag)
+
+    def test_culled_version_never_revives_older_entries(self):
+        from django.core.cache import cache
+        from whitefly.cache import _version_key
+
+        self.client.get('/api/results/')
+        self._add_result()
+        self.assertEqual(len(self.client.get('/api/results/').json()), 2)
+        # The cache backend evicts the version key, as FileBasedCache does when full
+        cache.delete(_version_key(self.user.pk))
+        response = self.client.get('/api/results/')
+        self.assertEqual(len(response.json()), 2)
+
+    def test_unused_query_parameters_share_one_entry(self):
+        self.client.get('/api/analysis/density/', {'junk': '1'})
+        with self.assertNumQueries(0):
+            response = self.client.get('/api/analysis/density/', {'junk': '2'})
+        self.assertIsNone(response.json()['grid'])
+        self.assertIsNotNone(self.client.get('/api/analysis/density/', {'grid': 'true'}).json()['grid'])
+
+
+class DetectionPoolTests(TestCase):
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmp, ignore_errors=True)
+
+    def _pool(self, urls, responses=None, **kwargs):
+        """Pool whose POSTs are answered by ``responses[url]``: a status code or an exception"""
+        from whitefly.balancer import DetectionPool, parse_endpoints
+
+        pool = DetectionPool(parse_endpoints(','.join(urls)), health_interval=0, **kwargs)
+        pool.posted = []
+
+        def post(url, files, timeout):
+            host = url.rsplit('/post', 1)[0]
+            pool.posted.append(host)
+            answer = (responses or {}).get(host, 200)
+            if isinstance(answer, Exception):
+                raise answer
+            return mock.Mock(status_code=answer)
+
+        pool._session = mock.Mock(post=mock.Mock(side_effect=post))
+        return pool
+
+    def test_connection_error_fails_over(self):
+        import requests
+
+        pool = self._pool(['http://a', 'http://b'], {'http://a': requests.ConnectionError('refused')})
+        # Both endpoints are tried whichever comes first
+        for _ in range(2):
+            self.assertEqual(pool.post('/post_single_file/', {}).status_code, 200)
+        self.assertIn('http://a', pool.posted)
+        self.assertEqual(pool.endpoints[0].failures, 1)
+
+    def test_server_error_fails_over(self):
+        pool = self._pool(['http://a', 'http://b'], {'http://a': 503})
+        for _ in range(2):
+            self.assertEqual(pool.post('/post_single_file/', {}).status_code, 200)
+        self.assertIn('http://a', pool.posted)
+
+    def test_failing_endpoint_is_ejected_then_restored_by_health_check(self):
+        pool = self._pool(['http://a', 'http://b'], {'http://a': 500}, max_failures=2)
+        while pool.endpoints[0].healthy:
+            pool.post('/post_single_file/', {})
+        self.assertEqual(pool.endpoints[0].failures, 2)
+
+        pool.posted.clear()
+        for _ in range(4):
+            pool.post('/post_single_file/', {})
+        self.assertEqual(set(pool.posted), {'http://b'})
+
+        with mock.patch('requests.get', return_value=mock.Mock(status_code=200)) as probe:
+            pool.check_health()
+        probe.assert_any_call('http://a/health', timeout=5)
+        self.assertTrue(pool.endpoints[0].healthy)
+
+    def test_outstanding_counts_are_shared_between_workers(self):
+        from whitefly.balancer import OutstandingStore
+
+        path = os.path.join(self.tmp, 'pool.sqlite3')
+        urls = ['http://a', 'http://b', 'http://c']
+        first = self._pool(urls, store=OutstandingStore(path))
+        second = self._pool(urls, store=OutstandingStore(path))
+
+        # The first worker has requests in flight on b and c
+        held = [first.acquire(), first.acquire()]
+        self.assertEqual({e.url for e, _ in held}, {'http://b', 'http://c'})
+        endpoint, ticket = second.acquire()
+        self.assertEqual(endpoint.url, 'http://a')
+
+        second.release(endpoint, ok=True, ticket=ticket)
+        for endpoint, ticket in held:
+            first.release(endpoint, ok=True, ticket=ticket)
+        counts = first.store._db.execute('SELECT COUNT(*) FROM detection_outstanding').fetchone()[0]
+        self.assertEqual(counts, 0)
@@ -1,44 +1,79 @@
 import os.path
 import datetime
-import requests
-import cv2
 import io
-from PIL import Image
-import numpy as np
 import csv
 
-url_single = "http://localhost:5000/post_single_file/"
-url_multi = "http://localhost:5000/multi_file_async/"
+# requests, cv2, numpy and PIL are imported inside the functions that use them,
+# so importing this module (every worker, every manage.py command) stays cheap.
+# Call preload_image_stack() to pay that cost up front instead.
 
+BASE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+results_dir = os.path.normpath(BASE_DIR + "/media/whitefly_results")
+
+# Detection API routes; the hosts come from settings.DETECTION_API_URLS
+path_single = "/post_single_file/"
+path_multi = "/multi_file_async/"
+
+
+def preload_image_stack():
+    """Import the image/HTTP libraries and run one tiny decode to warm them up"""
+    import requests  # noqa: F401
+    import cv2
+    import numpy as np
+
+    ok, encoded = cv2.imencode('.png', np.zeros((8, 8, 3), dtype=np.uint8))
+    decode_image(encoded.tobytes())
+
+
+def _post_detection(path, files, end_point=None):
+    from .balancer import get_pool
 
-def post_image(file_list=None, end_point=url_multi):
     try:
-        r = requests.post(url=end_point, files=file_list)
-        if r.status_code == 200:
+        if end_point is not None:
+            import requests
+            r = requests.post(url=end_point, files=files)
+        else:
+            # Routed to the least busy healthy endpoint, failing over on errors
+            r = get_pool().post(path, files)
+        if r is not None and r.status_code == 200:
             return r.json()
-        print(r.status_code)
+        print(r.status_code if r is not None else "No detection endpoint available")
         return "Failed to fetch results"
     except Exception as e:
         print(e)
 
 
-def post_single_image(image_data, end_point=url_single):
+def post_image(file_list=None, end_point=None):
+    return _post_detection(path_multi, file_list, end_point)
+
+
+def post_single_image(image_data, end_point=None):
     files = {'file': image_data}
-    try:
-        r = requests.post(url=end_point, files=files)
-        if r.status_code == 200:
-            return r.json()
-        print(r.status_code)
-        return "Failed to fetch results"
-    except Exception as e:
-        print(e)
+    return _post_detection(path_single, files, end_point)
 
 
-def draw_annotations(img_data, detections):
+def get_image_size(img_data):
+    from PIL import Image
+
+    # Only reads the header, the pixels are not decoded
+    return Image.open(io.BytesIO(img_data)).size
+
+
+def decode_image(img_data):
+    import cv2
+    import numpy as np
+    from PIL import Image
+
     # Load image and make it writable (copy to avoid read-only array)
-    img = np.array(Image.open(io.BytesIO(img_data)))
+    img = np.array(Image.open(io.BytesIO(img_data)).convert('RGB'))
     # Convert RGB to BGR for OpenCV
-    img = cv2.cvtColor(img, cv2.COLOR_RGB2BGR)
+    return cv2.cvtColor(img, cv2.COLOR_RGB2BGR)
+
+
+def draw_annotations(img_data, detections):
+    import cv2
+
+    img = decode_image(img_data)
     print(detections)
     for d in detections:
 
@@ -77,7 +112,29 @@ def draw_annotations(img_data, detections):
     return img
 
 
+def annotated_image_path(image_url):
+    # Annotated copies live in media/whitefly_results under the upload's file name
+    return os.path.normpath(results_dir + "/" + os.path.basename(image_url))
+
+
+def render_annotated_image(image_url, img_data, detections):
+    f_path = annotated_image_path(image_url)
+    os.makedirs(os.path.dirname(f_path), exist_ok=True)
+    return save_img(draw_annotations(img_data, detections), f_path)
+
+
+def ensure_annotated_image(image_url, original_path, detections):
+    """Path of the annotated copy, re-rendered from the original if retention removed it"""
+    f_path = annotated_image_path(image_url)
+    if not os.path.exists(f_path):
+        with open(original_path, 'rb') as f:
+            render_annotated_image(image_url, f.read(), detections)
+    return f_path
+
+
 def save_img(img_arr, path_to_save):
+    import cv2
+
     # Image is already in BGR format from draw_annotations, so save directly
     return cv2.imwrite(path_to_save, img_arr)
 
@@ -0,0 +1,84 @@
+"""Media views for uploads and annotated images.
+
+Only the owner of an image (or staff) can fetch it. Annotated images are
+deleted after RETENTION_ANNOTATED_DAYS and re-drawn here from the stored boxes
+on first access; originals moved to the cold tier are served from
+RETENTION_COLD_DIR. Both keep their /media/ URLs.
+
+The file itself is sent by Django only with DEBUG on, the same as the
+``static()`` media route; in production set MEDIA_ACCEL_REDIRECT so nginx
+sends it (X-Accel-Redirect) after the checks here.
+"""
+import mimetypes
+import os
+
+from django.conf import settings
+from django.http import FileResponse, Http404, HttpResponse
+
+from .models import Image, Result
+from .utilities import annotated_image_path, ensure_annotated_image
+
+
+UPLOAD_PREFIX = Image._meta.get_field('images').upload_to
+HEATMAP_PREFIX = 'heatmap_'
+
+
+def _image_for(request, name):
+    """The image stored under ``name``, if the requesting user may see it"""
+    if not request.user.is_authenticated:
+        raise Http404('Image not found')
+    # File names are unique within upload_to, and annotated copies reuse them
+    images = Image.objects.filter(images=UPLOAD_PREFIX + name)
+    if not request.user.is_staff:
+        images = images.filter(user=request.user)
+    image = images.first()
+    if image is None:
+        raise Http404('Image not found')
+    return image
+
+
+def _file_response(path, content_type=None):
+    """Send a checked file: directly in DEBUG, through nginx in production"""
+    content_type = content_type or mimetypes.guess_type(path)[0] or 'application/octet-stream'
+    if settings.DEBUG:
+        return FileResponse(open(path, 'rb'), content_type=content_type)
+    if not settings.MEDIA_ACCEL_REDIRECT:
+        raise Http404('Media is not served by Django with DEBUG off')
+
+    # MEDIA_ACCEL_REDIRECT/media/ maps MEDIA_ROOT, MEDIA_ACCEL_REDIRECT/cold/ maps RETENTION_COLD_DIR
+    for location, root in (('media', settings.MEDIA_ROOT), ('cold', settings.RETENTION_COLD_DIR)):
+        relative = os.path.relpath(path, root)
+        if not relative.startswith(os.pardir):
+            # nginx keeps this Content-Type when it follows the redirect
+            response = HttpResponse(content_type=content_type)
+            response['X-Accel-Redirect'] = (
+                f"{settings.MEDIA_ACCEL_REDIRECT.rstrip('/')}/{location}/{relative.replace(os.sep, '/')}"
+            )
+            return response
+    raise Http404('Image not found')
+
+
+def annotated_media_view(request, name):
+    """Serve an annotated image or heatmap, re-rendering a missing annotated image"""
+    # Heatmaps are named after the upload they were drawn for
+    image = _image_for(request, name[len(HEATMAP_PREFIX):] if name.startswith(HEATMAP_PREFIX) else name)
+    path = annotated_image_path(name)
+    if not os.path.isfile(path):
+        if name.startswith(HEATMAP_PREFIX):
+            # Heatmaps are redrawn by /api/results/<id>/heatmap/
+            raise Http404('Heatmap not found')
+        result = Result.objects.filter(image=image).order_by('-id').first()
+        if result is None or not os.path.exists(image.original_path()):
+            raise Http404('Annotated image not available')
+        path = ensure_annotated_image(image.images.url, image.original_path(), result.annotated_coordinates)
+    return _file_response(path)
+
+
+def upload_media_view(request, name):
+    """Serve an original upload from wherever its storage tier keeps it"""
+    image = _image_for(request, name)
+    path = image.original_path()
+    if not os.path.isfile(path):
+        raise Http404('Image not found')
+    # Recompressed originals are JPEG whatever their extension
+    return _file_response(path, 'image/jpeg' if image.storage_tier == Image.TIER_COMPRESSED else None)
@@ -4,10 +4,12 @@ This is a mock server for testing the whitefly detection upload functionality.
 It returns dummy detection results without running actual ML inference.
 
 Run this with: python detection_api_test.py
+Run several copies for load-balancing tests: python detection_api_test.py --port 5001
 """
 
 from flask import Flask, request, jsonify
 from flask_cors import CORS
+import argparse
 import random
 
 app = Flask(__name__)
@@ -84,13 +86,17 @@ def health():
     })
 
 if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Mock whitefly detection API')
+    parser.add_argument('--port', type=int, default=5000)
+    args = parser.parse_args()
+    
     print("=" * 60)
     print("🧪 TEST DETECTION API SERVER")
     print("=" * 60)
     print("This is a MOCK server for testing purposes only.")
     print("It returns random detection coordinates without ML inference.")
     print("")
-    print("Server running on: http://localhost:5000")
+    print(f"Server running on: http://localhost:{args.port}")
     print("Endpoints:")
     print("  - POST /post_single_file/")
     print("  - POST /multi_file_async/")
@@ -98,4 +104,4 @@ if __name__ == '__main__':
     print("=" * 60)
     print("")
     
-    app.run(host='0.0.0.0', port=5000, debug=True)
+    app.run(host='0.0.0.0', port=args.port, debug=True)